@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+"""Weighted aggregates (totals, counts of beneficiaries and means) of the variables of a simulation."""
+
+
+import numpy as np
+
+from . import calmar, model
+
+
+__all__ = ['Aggregates', 'compute_aggregates']
+
+
+class Aggregates(object):
+    """Weighted aggregates of columns, for the whole population and for each filter.
+
+    Arrays are indexed by (filter, column), in the order of filters_name and columns_name. The first filter name is
+    None, ie the whole population.
+    """
+    columns_name = None
+    count = None  # Weighted count of beneficiaries, ie of non-zero values
+    filters_name = None
+    total = None  # Weighted sum
+
+    def __init__(self, columns_name = None, count = None, filters_name = None, total = None):
+        self.columns_name = columns_name
+        self.count = count
+        self.filters_name = filters_name
+        self.total = total
+
+    def __sub__(self, other):
+        assert self.columns_name == other.columns_name and self.filters_name == other.filters_name
+        return self.__class__(columns_name = self.columns_name, count = self.count - other.count,
+            filters_name = self.filters_name, total = self.total - other.total)
+
+    def get(self, column_name, filter_name = None):
+        """Return a dict of the total, count and mean of a column."""
+        filter_index = self.filters_name.index(filter_name)
+        column_index = self.columns_name.index(column_name)
+        return dict(
+            count = self.count[filter_index, column_index],
+            mean = self.mean[filter_index, column_index],
+            total = self.total[filter_index, column_index],
+            )
+
+    @property
+    def mean(self):
+        """Mean value of the beneficiaries."""
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return self.total / self.count
+
+
+def compute_aggregates(simulation, columns_name = None, filters_name = None, reform_simulation = None,
+        weight_name = None):
+    """Compute the weighted aggregates of columns of any entity, for the whole population and for each filter.
+
+    Columns default to model.AGGREGATES_DEFAULT_VARS, filters to model.FILTERING_VARS and the weight column to
+    model.WEIGHT. Filters must belong to the entity of the weights. The weights and filters of each row of the weight
+    entity are given to its members through the entity index (cf calmar.get_weight_index), so that, for example,
+    individuals are counted with the weight of their household.
+
+    For each entity, the columns are aggregated by a single product of the matrix of the filtered weights with the
+    matrix of the values, without building any DataFrame.
+
+    When reform_simulation is given, its columns are aggregated in the same pass, with the weights and filters of
+    simulation, and the result is the pair (baseline aggregates, reform aggregates): their difference is the impact
+    of the reform.
+    """
+    if columns_name is None:
+        columns_name = model.AGGREGATES_DEFAULT_VARS
+    columns_name = list(columns_name)
+    if filters_name is None:
+        filters_name = model.FILTERING_VARS or []
+    filters_name = [None] + list(filters_name)
+    if weight_name is None:
+        weight_name = model.WEIGHT
+    weight_entity = simulation.entity_by_column_name[weight_name]
+
+    weights = simulation.compute(weight_name).astype(float)
+    filtered_weights = np.empty((len(filters_name), weight_entity.count))
+    filtered_weights[0] = weights
+    for filter_index, filter_name in enumerate(filters_name[1:], 1):
+        assert simulation.entity_by_column_name[filter_name] is weight_entity, \
+            'Filter {} does not belong to the entity of the weights'.format(filter_name)
+        np.multiply(weights, simulation.compute(filter_name) != 0, out = filtered_weights[filter_index])
+
+    simulations = [simulation] if reform_simulation is None else [simulation, reform_simulation]
+    count = np.empty((len(simulations), len(filters_name), len(columns_name)))
+    total = np.empty((len(simulations), len(filters_name), len(columns_name)))
+    columns_index_by_entity = {}
+    for column_index, column_name in enumerate(columns_name):
+        columns_index_by_entity.setdefault(simulation.entity_by_column_name[column_name], []).append(column_index)
+    for entity, columns_index in columns_index_by_entity.iteritems():
+        if entity is weight_entity:
+            entity_filtered_weights = filtered_weights
+        else:
+            entity_filtered_weights = filtered_weights.take(
+                calmar.get_weight_index(simulation, entity, weight_entity), axis = 1)
+        values = np.empty((len(simulations) * len(columns_index), entity.count))
+        row_index = 0
+        for simulation_index, current_simulation in enumerate(simulations):
+            for column_index in columns_index:
+                assert current_simulation.entity_by_column_name[columns_name[column_index]].count == entity.count
+                values[row_index] = current_simulation.compute(columns_name[column_index])
+                row_index += 1
+        entity_total = entity_filtered_weights.dot(values.T).reshape(len(filters_name), len(simulations), -1)
+        entity_count = entity_filtered_weights.dot((values != 0).T).reshape(len(filters_name), len(simulations), -1)
+        total[:, :, columns_index] = entity_total.transpose(1, 0, 2)
+        count[:, :, columns_index] = entity_count.transpose(1, 0, 2)
+
+    aggregates_list = [
+        Aggregates(columns_name = columns_name, count = count[simulation_index], filters_name = filters_name,
+            total = total[simulation_index])
+        for simulation_index in range(len(simulations))
+        ]
+    return aggregates_list[0] if reform_simulation is None else tuple(aggregates_list)
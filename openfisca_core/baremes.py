@@ -25,17 +25,19 @@
 
 from __future__ import division
 
-from bisect import bisect_right
+from bisect import bisect_left
 import itertools
 
 import numpy as np
-from numpy import maximum as max_, minimum as min_
+from numpy import maximum as max_
 
 
 class Bareme(object):
     '''
     Object qui contient des tranches d'imposition en taux marginaux et en taux moyen
     '''
+    _compiled = None  # Cache of the CompiledBareme, reset when tranches or tranchesM change
+
     def __init__(self, name = 'untitled Bareme', option = None, unit = None):
         super(Bareme, self).__init__()
         self._name = name
@@ -70,9 +72,11 @@ class Bareme(object):
     def setSeuil(self, i, value):
         self._tranches[i][0] = value
         self._tranches.sort()
+        self._compiled = None
 
     def setTaux(self, i, value):
         self._tranches[i][1] = value
+        self._compiled = None
 
     @property
     def seuilsM(self):
@@ -85,9 +89,11 @@ class Bareme(object):
     def setSeuilM(self, i, value):
         self._tranchesM[i][0] = value
         self._tranchesM.sort()
+        self._compiled = None
 
     def setTauxM(self, i, value):
         self._tranchesM[i][1] = value
+        self._compiled = None
 
 
     def multTaux(self, factor, inplace = True, new_name = None):
@@ -97,57 +103,50 @@ class Bareme(object):
         else:
             if new_name is None:
                 new_name = self._name
-            b = Bareme(new_name, option = self._option, unit = self.unit)
-            for i in range(self.nb):
-                b.addTranche(self.seuils[i], self.taux[i])
-            b.multTaux(factor, inplace = True)
-            return b
+            return build_bareme(self.seuils, np.array(self.taux) * factor, name = new_name, option = self._option,
+                unit = self.unit)
 
     def multSeuils(self, factor):
         '''
         Returns a new instance of Bareme with scaled 'seuils' and same 'taux'
         '''
-        b = Bareme(self._name, option = self._option, unit = self.unit)
-        for i in range(self.nb):
-            b.addTranche(factor * self.seuils[i], self.taux[i])
-        return b
+        return build_bareme(np.array(self.seuils) * factor, self.taux, name = self._name, option = self._option,
+            unit = self.unit)
 
     def addBareme(self, bareme):
         if bareme.nb > 0:  # Pour ne pas avoir de problèmes avec les barèmes vides
-            for seuilInf, seuilSup, taux  in zip(bareme.seuils[:-1], bareme.seuils[1:] , bareme.taux):
-                self.combineTranche(taux, seuilInf, seuilSup)
-            self.combineTranche(bareme.taux[-1], bareme.seuils[-1])  # Pour traiter le dernier seuil
+            self._set_tranches(*combine_tranches([self, bareme]))
 
     def combineTranche(self, taux, seuilInf = 0, seuilSup = False):
-        # Insertion de seuilInf et SeuilSup sans modfifer les taux
-        if not seuilInf in self.seuils:
-            index = bisect_right(self.seuils, seuilInf) - 1
-            self.addTranche(seuilInf, self.taux[index])
-
-        if seuilSup and not seuilSup in self.seuils:
-                index = bisect_right(self.seuils, seuilSup) - 1
-                self.addTranche(seuilSup, self.taux[index])
-
-        # On utilise addTranche pour ajouter les taux où il le faut
-        i = self.seuils.index(seuilInf)
-        if seuilSup: j = self.seuils.index(seuilSup) - 1
-        else: j = self._nb - 1
-        while (i <= j):
-            self.addTranche(self.seuils[i], taux)
-            i += 1
+        '''
+        Ajoute 'taux' aux taux marginaux entre seuilInf et seuilSup (l'infini si seuilSup est False)
+        '''
+        if seuilSup:
+            tranche = build_bareme([seuilInf, seuilSup], [taux, 0])
+        else:
+            tranche = build_bareme([seuilInf], [taux])
+        self._set_tranches(*combine_tranches([self, tranche]))
 
     def addTranche(self, seuil, taux):
-        if seuil in self.seuils:
-            i = self.seuils.index(seuil)
-            self.setTaux(i, self.taux[i] + taux)
+        # Les tranches sont triées par seuil : recherche par dichotomie et insertion à sa place.
+        tranches = self._tranches
+        i = bisect_left(tranches, [seuil])
+        if i < len(tranches) and tranches[i][0] == seuil:
+            self.setTaux(i, tranches[i][1] + taux)
         else:
-            self._tranches.append([seuil, taux])
-            self._tranches.sort()
-            self._nb = len(self._tranches)
+            tranches.insert(i, [seuil, taux])
+            self._nb = len(tranches)
+            self._compiled = None
+
+    def _set_tranches(self, seuils, taux):
+        self._tranches = [[seuil, tranche_taux] for seuil, tranche_taux in itertools.izip(seuils, taux)]
+        self._nb = len(self._tranches)
+        self._compiled = None
 
     def rmvTranche(self):
         self._tranches.pop()
         self._nb = len(self._tranches)
+        self._compiled = None
 
     def addTrancheM(self, seuil, taux):
         if seuil in self.seuilsM:
@@ -155,25 +154,24 @@ class Bareme(object):
             self.setTauxM(i, self.tauxM[i] + taux)
         else:
             self._tranchesM.append([seuil, taux])
+            self._compiled = None
 
     def marToMoy(self):
         self._tranchesM = []
-        I, k = 0, 0
+        self._compiled = None
         if self.nb > 0:
-            for seuil, taux in self:
-                if k == 0:
-                    sprec = seuil
-                    tprec = taux
-                    k += 1
-                    continue
-                I += tprec * (seuil - sprec)
-                self.addTrancheM(seuil, I / seuil)
-                sprec = seuil
-                tprec = taux
-            self.addTrancheM('Infini', taux)
+            # Taux moyen à chaque seuil : impôt cumulé au seuil divisé par le seuil
+            seuils = np.array(self.seuils, dtype = np.float64)
+            cumul = np.cumsum(np.array(self.taux[:-1], dtype = np.float64) * np.diff(seuils))
+            self._tranchesM = [
+                [seuil, tauxM]
+                for seuil, tauxM in itertools.izip(self.seuils[1:], (cumul / seuils[1:]).tolist())
+                ]
+            self._tranchesM.append(['Infini', self.taux[-1]])
 
     def moyToMar(self):
         self._tranches = []
+        self._compiled = None
         Iprev, sprev = 0, 0
         z = zip(self.seuilsM, self.tauxM)
         for seuil, taux in z:
@@ -197,16 +195,7 @@ class Bareme(object):
                 représentation du revenu imposable comme fonction linéaire par
                 morceaux du revenu brut
         '''
-        inverse = Bareme(self._name + "'")  # En fait 1/(1-taux_global)
-        seuilImp, taux = 0, 0
-        for seuil, taux in self:
-            if seuil == 0: theta, tauxp = 0, 0
-            # On calcul le seuil de revenu imposable de la tranche considérée
-            seuilImp = (1 - tauxp) * seuil + theta
-            inverse.addTranche(seuilImp, 1 / (1 - taux))
-            theta = (taux - tauxp) * seuil + theta
-            tauxp = taux  # taux précédent
-        return inverse
+        return self.compile().inverse().to_bareme()
 
     def __iter__(self):
         return itertools.izip(self.seuils, self.taux)
@@ -228,43 +217,280 @@ class Bareme(object):
         Calcule un impôt selon le barême non linéaire exprimé en tranches de taux marginaux.
         'assiette' est l'assiette de l'impôt, en colonne
         '''
-        k = self.nb
+        return self.compile().calc(assiette, getT = getT)
+
+    def compile(self):
+        '''
+        Returns the CompiledBareme of the current tranches (cached until the tranches change)
+        '''
+        compiled = self._compiled
+        # _linear_taux_moy is an attribute, which may be set after the compilation.
+        if compiled is None or compiled._linear_taux_moy != self._linear_taux_moy:
+            self._compiled = compiled = CompiledBareme(self.seuils, self.taux, tauxM = self.tauxM,
+                linear_taux_moy = self._linear_taux_moy, name = self._name, option = self._option, unit = self.unit)
+        return compiled
+
+    def t_x(self):
+        return self.compile().t_x()
+
+
+class CompiledBareme(object):
+    '''
+    Barème figé : seuils, taux et tables dérivées (impôt cumulé aux seuils, pentes du taux moyen) sous forme de
+    tableaux numpy contigus (seuils_array, taux_array, tauxM_array), calculés une seule fois. Comme pour Bareme,
+    seuils, taux et tauxM sont des listes.
+
+    Les barèmes d'une législation compacte figée restent des Bareme, qui gardent leur barème compilé en cache. Les
+    variantes obtenues par multSeuils sont gardées en cache par facteur, ce qui évite de reconstruire un barème à
+    chaque appel de scaleBaremes sur un CompiledBareme.
+    '''
+    __slots__ = ('_inverse', '_linear_taux_moy', '_name', '_option', '_scaled_by_factor', '_t_x', 'cumul',
+        'seuils_array', 'taux_array', 'tauxM_array', 'unit')
+
+    def __init__(self, seuils, taux, tauxM = None, linear_taux_moy = False, name = 'untitled Bareme', option = None,
+            unit = None):
+        self._inverse = None
+        self._linear_taux_moy = linear_taux_moy
+        self._name = name
+        self._option = option
+        self._scaled_by_factor = {}
+        self.unit = unit
+
+        self.seuils_array = seuils = np.array(seuils, dtype = np.float64)
+        self.taux_array = taux = np.array(taux, dtype = np.float64)
+        assert seuils.shape == taux.shape
+        self.cumul = cumul = np.zeros(len(seuils))
+        np.cumsum(taux[:-1] * np.diff(seuils), out = cumul[1:])
+        self.tauxM_array = tauxM = np.array(tauxM if tauxM is not None else [], dtype = np.float64)
+        if len(seuils) > 0 and len(tauxM) >= len(seuils) - 1:
+            t = np.zeros(len(seuils))
+            t[1:] = tauxM[:len(seuils) - 1]
+            self._t_x = np.diff(t) / np.diff(seuils)
+        else:
+            self._t_x = None
+        for array in (seuils, taux, cumul, tauxM, self._t_x):
+            if array is not None:
+                array.flags.writeable = False
+
+    def __eq__(self, other):
+        # Like Bareme, compare the tranches only (not tauxM, option nor unit).
+        if not isinstance(other, CompiledBareme):
+            return NotImplemented
+        return np.array_equal(self.seuils_array, other.seuils_array) \
+            and np.array_equal(self.taux_array, other.taux_array)
+
+    def __hash__(self):
+        return hash((self.seuils_array.tostring(), self.taux_array.tostring()))
+
+    def __iter__(self):
+        return itertools.izip(self.seuils_array.tolist(), self.taux_array.tolist())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __reduce__(self):
+        return (CompiledBareme, (self.seuils_array, self.taux_array, self.tauxM_array, self._linear_taux_moy,
+            self._name, self._option, self.unit))
+
+    def __str__(self):
+        output = self._name + '\n'
+        for seuil, taux in self:
+            output += str(seuil) + '  ' + str(taux) + '\n'
+        return output
+
+    def calc(self, assiette, getT = False):
+        '''
+        Calcule un impôt selon le barême non linéaire exprimé en tranches de taux marginaux.
+        'assiette' est l'assiette de l'impôt, en colonne
+        '''
+        assiette = np.asarray(assiette)
+        seuils = self.seuils_array
+        k = len(seuils)
         n = len(assiette)
         if not self._linear_taux_moy:
-            assi = np.tile(assiette, (k, 1)).T
-            seui = np.tile(np.hstack((self.seuils, np.inf)), (n, 1))
-            a = max_(min_(assi, seui[:, 1:]) - seui[:, :-1], 0)
-            i = np.dot(self.taux, a.T)
-            if getT:
-                t = np.squeeze(max_(np.dot((a > 0), np.ones((k, 1))) - 1, 0))
-                return i, t
+            # Localise la tranche de chaque assiette par dichotomie, puis ajoute à l'impôt cumulé au seuil de la tranche
+            # l'impôt dû dans la tranche : pas de matrice n x k.
+            if k == 0:
+                i = np.zeros(n)
             else:
-                return i
+                tranche = np.searchsorted(seuils, assiette, side = 'right') - 1
+                below = tranche < 0
+                tranche[below] = 0
+                i = self.cumul.take(tranche) + self.taux_array.take(tranche) * (assiette - seuils.take(tranche))
+                i[below] = 0
         else:
-            if len(self.tauxM) == 1:
-                i = assiette * self.tauxM[0]
+            # Interpolation linéaire du taux moyen dans la tranche de chaque assiette, localisée par dichotomie.
+            tauxM = self.tauxM_array
+            if len(tauxM) == 0:
+                i = np.zeros(n)
+            elif len(tauxM) == 1:
+                i = assiette * tauxM[0]
             else:
-                assi = np.tile(assiette, (k - 1, 1)).T
-                seui = np.tile(np.hstack(self.seuils), (n, 1))
-                k = self.t_x().T
-                a = (assi >= seui[:, :-1]) * (assi < seui[:, 1:])
-                A = np.dot(a, self.t_x().T)
-                B = np.dot(a, np.array(self.seuils[1:]))
-                C = np.dot(a, np.array(self.tauxM[:-1]))
-                i = assiette * (A * (assiette - B) + C) + max_(assiette - self.seuils[-1], 0) * self.tauxM[-1] + (assiette >= self.seuils[-1]) * self.seuils[-1] * self.tauxM[-2]
+                tranche = np.searchsorted(seuils, assiette, side = 'right') - 1
+                # Seules les tranches intermédiaires sont interpolées.
+                outside = (tranche < 0) | (tranche > k - 2)
+                tranche[outside] = 0
+                i = assiette * (self._t_x.take(tranche) * (assiette - seuils.take(tranche + 1)) + tauxM.take(tranche))
+                i[outside] = 0
+                i += max_(assiette - seuils[-1], 0) * tauxM[-1] + (assiette >= seuils[-1]) * seuils[-1] * tauxM[-2]
+        if getT:
+            # Numéro de la dernière tranche dont le seuil est strictement dépassé
+            t = max_(np.searchsorted(seuils, assiette, side = 'left') - 1, 0) if k > 0 else np.zeros(n, dtype = int)
+            return i, t
+        else:
+            return i
+
+    def compile(self):
+        return self
+
+    def inverse(self):
+        '''
+        Returns the (cached) inverse CompiledBareme, cf Bareme.inverse
+        Les seuils du barème inverse sont les revenus nets aux seuils (seuil - impôt cumulé au seuil) et ses taux
+        sont 1 / (1 - taux).
+        '''
+        inverse = self._inverse
+        if inverse is None:
+            seuils_nets = self.seuils_array - self.cumul
+            taux_inverses = 1 / (1 - self.taux_array)
+            if len(seuils_nets) == 0 or seuils_nets[0] > 0:
+                # Sous le premier seuil, le revenu net est égal au revenu brut.
+                seuils_nets = np.concatenate(([0], seuils_nets))
+                taux_inverses = np.concatenate(([1], taux_inverses))
+            self._inverse = inverse = CompiledBareme(seuils_nets, taux_inverses, name = self._name + "'")
+        return inverse
+
+    def multSeuils(self, factor):
+        '''
+        Returns a CompiledBareme with scaled 'seuils' and same 'taux' (cached by factor)
+        The factor must be a scalar: the seuils of a barème can't depend on the row.
+        '''
+        if not np.isscalar(factor):
+            raise ValueError('CompiledBareme.multSeuils requires a scalar factor, not {!r}'.format(factor))
+        scaled = self._scaled_by_factor.get(factor)
+        if scaled is None:
+            # Le taux moyen aux seuils est inchangé quand les seuils sont multipliés par un même facteur.
+            scaled = CompiledBareme(self.seuils_array * factor, self.taux_array, tauxM = self.tauxM_array,
+                name = self._name, option = self._option, unit = self.unit)
+            self._scaled_by_factor[factor] = scaled
+        return scaled
+
+    def multTaux(self, factor, inplace = False, new_name = None):
+        '''
+        Returns a new CompiledBareme with scaled 'taux' (a CompiledBareme is immutable: it can't be scaled in place)
+        '''
+        assert not inplace, 'A CompiledBareme is immutable: use the CompiledBareme returned by multTaux'
+        return CompiledBareme(self.seuils_array, self.taux_array * factor, tauxM = self.tauxM_array * factor,
+            name = new_name if new_name is not None else self._name, option = self._option, unit = self.unit)
+
+    @property
+    def nb(self):
+        return len(self.seuils_array)
+
+    @property
+    def option(self):
+        return self._option
+
+    @property
+    def seuils(self):
+        '''List of the thresholds, as in Bareme (cf seuils_array for the array)'''
+        return self.seuils_array.tolist()
+
+    def t_x(self):
+        return self._t_x
+
+    @property
+    def taux(self):
+        '''List of the marginal rates, as in Bareme (cf taux_array for the array)'''
+        return self.taux_array.tolist()
+
+    @property
+    def tauxM(self):
+        return self.tauxM_array.tolist()
+
+    def to_bareme(self):
+        '''
+        Returns a new (mutable) Bareme with the same tranches
+        '''
+        bareme = Bareme(self._name, option = self._option, unit = self.unit)
+        bareme._tranches = [[seuil, taux] for seuil, taux in itertools.izip(self.seuils_array.tolist(),
+            self.taux_array.tolist())]
+        bareme._nb = len(bareme._tranches)
+        bareme._linear_taux_moy = self._linear_taux_moy
+        if len(self.tauxM_array):
+            bareme.marToMoy()
+        return bareme
+
+
+class VectorialBareme(object):
+    '''
+    Bareme qui dépend de la ligne : chaque ligne est calculée avec le barème de sa date.
+
+    'baremes' contient un barème (ou None) par date et 'index' donne pour chaque ligne la position de son barème.
+    '''
+    def __init__(self, baremes, index, rows_by_position = None):
+        super(VectorialBareme, self).__init__()
+        self.baremes = baremes
+        self.index = index
+        self._rows_by_position = rows_by_position
+
+    @property
+    def rows_by_position(self):
+        rows_by_position = self._rows_by_position
+        if rows_by_position is None:
+            from .legislations import group_rows_by_index
+            rows_by_position = self._rows_by_position = group_rows_by_index(self.index, len(self.baremes))
+        return rows_by_position
+
+    def calc(self, assiette, getT = False):
+        '''
+        Calcule l'impôt de chaque ligne avec le barème en vigueur à sa date.
+        '''
+        assiette = np.asarray(assiette)
+        i = np.zeros(len(assiette))
+        if getT:
+            t = np.zeros(len(assiette), dtype = np.int32)
+        for bareme, rows in itertools.izip(self.baremes, self.rows_by_position):
+            if bareme is None or bareme.nb == 0 or len(rows) == 0:
+                continue
             if getT:
-                t = np.squeeze(max_(np.dot((a > 0), np.ones((k, 1))) - 1, 0))
-                return i, t
+                i[rows], t[rows] = bareme.calc(assiette[rows], getT = True)
             else:
-                return i
+                i[rows] = bareme.calc(assiette[rows])
+        if getT:
+            return i, t
+        return i
 
-    def t_x(self):
-        s = self.seuils
-        t = [0]
-        t.extend(self.tauxM[:-1])
-        s = np.array(s)
-        t = np.array(t)
-        return (t[1:] - t[:-1]) / (s[1:] - s[:-1])
+    def multSeuils(self, factor):
+        '''
+        Returns a new instance of VectorialBareme with scaled 'seuils' and same 'taux'
+        '''
+        return VectorialBareme(
+            [
+                bareme.multSeuils(factor) if bareme is not None else None
+                for bareme in self.baremes
+                ],
+            self.index,
+            rows_by_position = self._rows_by_position,
+            )
+
+    def multTaux(self, factor, inplace = True, new_name = None):
+        if inplace:
+            # Compiled baremes are immutable: replace them by their scaled copies.
+            self.baremes = [
+                bareme.multTaux(factor, inplace = False) if bareme is not None else None
+                for bareme in self.baremes
+                ]
+        else:
+            return VectorialBareme(
+                [
+                    bareme.multTaux(factor, inplace = False, new_name = new_name) if bareme is not None else None
+                    for bareme in self.baremes
+                    ],
+                self.index,
+                rows_by_position = self._rows_by_position,
+                )
 
 
 class BaremeDict(dict):
@@ -280,16 +506,18 @@ class BaremeDict(dict):
 
     def init_from_compact_node(self, compact_node):
         '''Initialize a BaremeDict from a CompactNode.'''
-        from .legislations import CompactNode
+        from .legislations import CompactNode, FrozenCompactNode
         from .parameters import Tree2Object
 
-        if isinstance(compact_node, Bareme):
+        if isinstance(compact_node, (Bareme, CompiledBareme)):
             self[compact_node._name] = compact_node
-        elif isinstance(compact_node, (CompactNode, Tree2Object)):
-            for key, bar in compact_node.__dict__.iteritems():
-                if isinstance(bar, Bareme):
+        elif isinstance(compact_node, (CompactNode, FrozenCompactNode, Tree2Object)):
+            items = compact_node.__dict__.iteritems() if isinstance(compact_node, Tree2Object) \
+                else compact_node.iteritems()
+            for key, bar in items:
+                if isinstance(bar, (Bareme, CompiledBareme)):
                     self[key] = bar
-                elif isinstance(bar, (CompactNode, Tree2Object)):
+                elif isinstance(bar, (CompactNode, FrozenCompactNode, Tree2Object)):
                     self[key] = BaremeDict(key, bar)
 
     def log(self, tabLevel = -1):
@@ -302,7 +530,7 @@ class BaremeDict(dict):
         output += "|------" + self._name + "\n"
 
         for name, bar in self.iteritems():
-            if isinstance(bar, Bareme):
+            if isinstance(bar, (Bareme, CompiledBareme)):
                 for i in range(tabLevel + 1):
                     output += "\t"
                 output += "|------" + bar.__str__() + '\n'
@@ -317,34 +545,96 @@ class BaremeDict(dict):
         return self.log()
 
 
+def build_bareme(seuils, taux, name = 'untitled Bareme', option = None, unit = None):
+    '''
+    Builds a Bareme from all its tranches at once, in O(k log k).
+    As with addTranche, the taux of tranches having the same seuil are added.
+    '''
+    seuils, inverse = np.unique(np.asarray(seuils, dtype = np.float64), return_inverse = True)
+    summed_taux = np.zeros(len(seuils))
+    np.add.at(summed_taux, inverse, np.asarray(taux, dtype = np.float64))
+    bareme = Bareme(name = name, option = option, unit = unit)
+    bareme._set_tranches(seuils.tolist(), summed_taux.tolist())
+    return bareme
+
+
+def combine_tranches(baremes, seuils = None):
+    '''
+    Returns the (seuils, taux) lists of the sum of the given baremes.
+
+    The seuils are the sorted union of the seuils of the baremes (and of the optional extra seuils). The taux at each
+    seuil is the sum of the taux of the tranches containing it, accumulated for all baremes in a single np.add.at.
+    '''
+    tranches = [
+        (np.asarray(bareme.seuils, dtype = np.float64), np.asarray(bareme.taux, dtype = np.float64))
+        for bareme in baremes
+        if bareme.nb > 0
+        ]
+    all_seuils = [bareme_seuils for bareme_seuils, bareme_taux in tranches]
+    if seuils is not None:
+        all_seuils.append(np.asarray(seuils, dtype = np.float64))
+    if not all_seuils:
+        return [], []
+    combined_seuils = np.unique(np.concatenate(all_seuils))
+    positions = []
+    values = []
+    for bareme_seuils, bareme_taux in tranches:
+        tranche = np.searchsorted(bareme_seuils, combined_seuils, side = 'right') - 1
+        inside = tranche >= 0  # Pas d'impôt sous le premier seuil d'un barème
+        positions.append(np.flatnonzero(inside))
+        values.append(bareme_taux.take(tranche[inside]))
+    combined_taux = np.zeros(len(combined_seuils))
+    if positions:
+        np.add.at(combined_taux, np.concatenate(positions), np.concatenate(values))
+    return combined_seuils.tolist(), combined_taux.tolist()
+
+
 def combineBaremes(bardict, name = None):
     '''
-    Combine all the Baremes in the BaremeDict in a signle Bareme
+    Combine all the Baremes in the BaremeDict (including the ones of its sub-BaremeDicts) in a signle Bareme
     '''
     if name is None:
         name = 'Combined ' + bardict._name
     baremeTot = Bareme(name = name)
-    baremeTot.addTranche(0, 0)
-    for name, bar in bardict.iteritems():
-        if isinstance(bar, Bareme):
-            baremeTot.addBareme(bar)
-        else:
-            combineBaremes(bar, baremeTot)
+    baremeTot._set_tranches(*combine_tranches(iter_baremes(bardict), seuils = [0]))
     return baremeTot
 
 
+def iter_baremes(bardict):
+    for bar in bardict.itervalues():
+        if isinstance(bar, (Bareme, CompiledBareme)):
+            yield bar
+        else:
+            for sub_bar in iter_baremes(bar):
+                yield sub_bar
+
+
+def net_to_gross(net, *baremes):
+    '''
+    Returns the gross revenue such that net = gross - sum of the taxes computed with the (marginal) baremes on gross.
+
+    The baremes are summed into a single piecewise-linear scale, whose inverse is evaluated exactly with one
+    searchsorted over its breakpoints: no fixed-point iteration. The total marginal rate must stay below 1.
+    '''
+    for bareme in baremes:
+        assert not bareme._linear_taux_moy, 'net_to_gross requires baremes expressed with marginal rates'
+    seuils, taux = combine_tranches(baremes, seuils = [0])
+    assert all(taux_total < 1 for taux_total in taux), 'net_to_gross requires total marginal rates below 1'
+    return CompiledBareme(seuils, taux).inverse().calc(net)
+
+
 def scaleBaremes(bar_dict, factor):
     '''
     Scales all the Bareme in the BarColl
     '''
-    if isinstance(bar_dict, Bareme):
+    if isinstance(bar_dict, (Bareme, CompiledBareme, VectorialBareme)):
         return bar_dict.multSeuils(factor)
 
     if isinstance(bar_dict, BaremeDict):
         out = BaremeDict(name = bar_dict._name)
 
         for key, bar in bar_dict.iteritems():
-            if isinstance(bar, Bareme):
+            if isinstance(bar, (Bareme, CompiledBareme, VectorialBareme)):
                 out[key] = bar.multSeuils(factor)
             elif isinstance(bar, BaremeDict):
                 out[key] = scaleBaremes(bar, factor)
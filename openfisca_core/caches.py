@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Memoization of the results of test cases."""
+
+
+import collections
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import zipfile
+
+import numpy as np
+
+from . import conv, legislations
+
+
+__all__ = ['canonicalize_test_case', 'get_result_key', 'hash_test_case', 'ResultCache']
+
+
+class ResultCache(object):
+    """LRU cache of the arrays computed for test cases, optionally stored in a directory to be shared by processes.
+
+    Keys are strings, cf get_result_key. Values are dicts of arrays by column name, that must not be modified.
+
+    The directory keeps at most about max_disk_count files: the least recently used ones (by modification time, which
+    reads update) are removed regularly. A file that can't be read, for example truncated, is a cache miss.
+    """
+    directory = None
+    lock = None
+    max_disk_count = None
+    max_size = None
+    result_by_key = None
+    stored_count = None  # Number of files stored since the last pruning of the directory
+
+    def __init__(self, directory = None, max_disk_count = 65536, max_size = 1024):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.max_disk_count = max_disk_count
+        self.max_size = max_size
+        self.result_by_key = collections.OrderedDict()
+        self.stored_count = 0
+
+    def get(self, key, default = None):
+        with self.lock:
+            result = self.result_by_key.pop(key, None)
+            if result is not None:
+                # Move key to the end, ie most recently used.
+                self.result_by_key[key] = result
+                return result
+        if self.directory is None:
+            return default
+        path = os.path.join(self.directory, key + '.npz')
+        try:
+            with np.load(path) as npz_file:
+                result = dict(
+                    (column_name, npz_file['arr_{}'.format(index)])
+                    for index, column_name in enumerate(npz_file['columns_name'].tolist())
+                    )
+            os.utime(path, None)
+        except (EOFError, IOError, KeyError, OSError, ValueError, zipfile.BadZipfile):
+            # Missing, partial or corrupted file
+            return default
+        self.set(key, result, store = False)
+        return result
+
+    def prune(self):
+        """Remove the least recently used files of the directory, beyond max_disk_count."""
+        mtime_and_path_list = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith('.npz'):
+                continue
+            path = os.path.join(self.directory, file_name)
+            try:
+                mtime_and_path_list.append((os.path.getmtime(path), path))
+            except OSError:
+                # Removed by another process
+                continue
+        if len(mtime_and_path_list) <= self.max_disk_count:
+            return
+        mtime_and_path_list.sort()
+        for mtime, path in mtime_and_path_list[:len(mtime_and_path_list) - self.max_disk_count]:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+    def set(self, key, array_by_column_name, store = True):
+        with self.lock:
+            self.result_by_key.pop(key, None)
+            self.result_by_key[key] = array_by_column_name
+            while len(self.result_by_key) > self.max_size:
+                self.result_by_key.popitem(last = False)
+        if store and self.directory is not None:
+            # Columns are stored as arr_0, arr_1, etc, with their names in columns_name, because column names could
+            # clash with the arguments of np.savez.
+            columns_name = sorted(array_by_column_name)
+            # Write to a temporary file and rename it, so that other processes never read a partial file.
+            file_descriptor, temporary_path = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+            with os.fdopen(file_descriptor, 'wb') as npz_file:
+                np.savez(npz_file, *[array_by_column_name[column_name] for column_name in columns_name],
+                    columns_name = np.array(columns_name))
+            os.rename(temporary_path, os.path.join(self.directory, key + '.npz'))
+            if self.max_disk_count is not None:
+                with self.lock:
+                    self.stored_count += 1
+                    prune = self.stored_count > self.max_disk_count // 8
+                    if prune:
+                        self.stored_count = 0
+                if prune:
+                    self.prune()
+
+
+def canonicalize_test_case(test_case, column_by_name):
+    """Return the canonical form of a test case, whose hash doesn't depend on the way it was written.
+
+    A test case is a dict giving, for each entity name, the list of its members, each member being a dict of JSON
+    values by column name. The values are converted by the json_to_python of their column, and the values equal to
+    the column default are removed. Members stay in their order, because it is the one used by the id columns. Keys
+    that are not columns (like the "id" of a member) raise a ValueError: ignoring them could give the same hash to
+    different test cases.
+    """
+    canonical_test_case = {}
+    for entity_name, members in test_case.iteritems():
+        canonical_members = []
+        for member in members:
+            canonical_member = {}
+            for column_name, value in member.iteritems():
+                column = column_by_name.get(column_name)
+                if column is None:
+                    raise ValueError(u'Test case of entity {} has a value for {}, which is not a column'.format(
+                        entity_name, column_name).encode('utf-8'))
+                value = conv.check(column.json_to_python)(value)
+                if value is None or value == column._default:
+                    continue
+                if isinstance(value, datetime.date):
+                    value = value.isoformat()
+                canonical_member[column_name] = value
+            canonical_members.append(canonical_member)
+        canonical_test_case[entity_name] = canonical_members
+    return canonical_test_case
+
+
+def get_result_key(test_case_hash, compact_legislation, date, columns_name):
+    """Return the key of the result of a test case in a ResultCache.
+
+    The legislation is identified by its fingerprint, which only a FrozenCompactNode has: a mutable CompactNode is
+    frozen first, at each call, because it may have changed since the previous one.
+    """
+    if isinstance(compact_legislation, legislations.CompactNode):
+        compact_legislation = compact_legislation.freeze()
+    sha1 = hashlib.sha1()
+    sha1.update(test_case_hash)
+    sha1.update(compact_legislation.fingerprint())
+    sha1.update(date.isoformat())
+    sha1.update(u'\n'.join(sorted(columns_name)).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def hash_test_case(test_case, column_by_name):
+    """Return a hash of the canonical form of a test case."""
+    canonical_json = json.dumps(canonicalize_test_case(test_case, column_by_name), ensure_ascii = True,
+        separators = (',', ':'), sort_keys = True)
+    return hashlib.sha1(canonical_json).hexdigest()
@@ -25,14 +25,17 @@
 
 from __future__ import division
 
-import operator
+import itertools
+import time
 
-from numpy import exp, ones, zeros, unique, array, dot, float64
-try:
-    from scipy.optimize import fsolve
-except:
-    pass
+import numpy as np
+from numpy import exp, ones, zeros, unique, array, float64
 
+from . import model
+
+
+# Distance functions and their derivatives, kept for backward compatibility: calibrate uses the fused functions of
+# distance_builder_by_method.
 
 def linear(u):
     return 1+u
@@ -55,9 +58,86 @@ def logit_prime(u,low,up):
     return ((a*up*(1-low)*exp(a*u))*(up-1+(1-low)*exp(a*u))-
               (low*(up-1)+up*(1-low)*exp(a*u))*(1-low)*a*exp(a*u))/(up-1+(1-low)*exp(a*u))**2
 
+# Distance functions, computing F(u) and F'(u) together in the given arrays, with no temporary array
+
+
+def build_linear_distance(param):
+    def linear_distance(u, F_out, F_prime_out):
+        np.add(u, 1, out = F_out)
+        F_prime_out.fill(1)
+    return linear_distance
+
+
+def build_logit_distance(param):
+    low, up = check_bounds(param, 'logit')
+    a = (up - low) / ((1 - low) * (up - 1))
+    # F(u) = (low * (up - 1) + up * (1 - low) * exp(a * u)) / (up - 1 + (1 - low) * exp(a * u)) is computed from
+    # q = 1 / (1 - low + (up - 1) * exp(-a * u)), which needs a single exp and doesn't overflow.
+    F_q_factor = (1 - low) * (up - low)
+    F_prime_q_factor = a * (1 - low) * (up - low)
+
+    def logit_distance(u, F_out, F_prime_out):
+        np.multiply(u, -a, out = F_out)
+        with np.errstate(over = 'ignore'):
+            # An infinite exp gives q = 0, which is right.
+            np.exp(F_out, out = F_out)
+        F_out *= up - 1
+        F_out += 1 - low
+        np.reciprocal(F_out, out = F_out)
+        # F'(u) = a * (1 - low) * (up - low) * q * (1 - (1 - low) * q)
+        np.multiply(F_out, low - 1, out = F_prime_out)
+        F_prime_out += 1
+        F_prime_out *= F_out
+        F_prime_out *= F_prime_q_factor
+        # F(u) = low + (1 - low) * (up - low) * q
+        F_out *= F_q_factor
+        F_out += low
+    return logit_distance
+
+
+def build_raking_ratio_distance(param):
+    def raking_ratio_distance(u, F_out, F_prime_out):
+        np.exp(u, out = F_out)
+        F_prime_out[:] = F_out
+    return raking_ratio_distance
+
+
+def build_truncated_linear_distance(param):
+    low, up = check_bounds(param, 'truncated linear')
+
+    def truncated_linear_distance(u, F_out, F_prime_out):
+        np.add(u, 1, out = F_out)
+        np.clip(F_out, low, up, out = F_out)
+        # F' is 1 where the ratio isn't truncated, 0 elsewhere.
+        np.greater(F_out, low, out = F_prime_out)
+        F_prime_out *= F_out < up
+    return truncated_linear_distance
+
+
+distance_builder_by_method = {
+    'linear': build_linear_distance,
+    'logit': build_logit_distance,
+    'raking ratio': build_raking_ratio_distance,
+    'truncated linear': build_truncated_linear_distance,
+    }  # Functions returning the distance function of a method, given the calmar param. Others can be registered.
+
+
+def check_bounds(param, method):
+    if not 'up' in param:
+        raise Exception("When method is '%s', 'up' parameter is needed in param" % method)
+    if not 'lo' in param:
+        raise Exception("When method is '%s', 'lo' parameter is needed in param" % method)
+    if param['up'] <= 1:
+        raise Exception("When method is '%s', 'up' should be strictly greater than 1" % method)
+    if param['lo'] >= 1:
+        raise Exception("When method is '%s', 'lo' should be strictly less than 1" % method)
+    return param['lo'], param['up']
+
+
 def build_dummies_dict(data):
     '''
     return a dict with unique values as keys and vectors as values
+    Kept for backward compatibility: calibrate_weights encodes categories with build_codes.
     '''
     unique_val_list = unique(data)
     output = {}
@@ -65,7 +145,198 @@ def build_dummies_dict(data):
         output[val] = (data==val)
     return output
 
+def build_codes(data, categories):
+    '''
+    Return the position of each value of data in the sorted categories, or len(categories) when it is not one of them
+    '''
+    categories = array(sorted(categories))
+    codes = categories.searchsorted(data)
+    absent = categories.take(codes, mode = 'clip') != data
+    codes[absent] = len(categories)
+    return codes
+
+
+def design_dot(blocks, offsets, lambdas, out, buffer):
+    '''
+    Compute x.lambdas in out, where x is the design matrix described by blocks (cf calibrate)
+    '''
+    out.fill(0)
+    for (codes, values, size), offset in itertools.izip(blocks, offsets):
+        if codes is None:
+            if values is None:
+                out += lambdas[offset]
+            else:
+                out += lambdas[offset] * values
+            continue
+        # Rows whose code is size belong to no category of the block: append a null multiplier for them.
+        block_lambdas = np.append(lambdas[offset:offset + size], 0)
+        block_lambdas.take(codes, out = buffer)
+        if values is not None:
+            buffer *= values
+        out += buffer
+    return out
+
+
+def design_gram(blocks, offsets, weights, buffers):
+    '''
+    Return x'.diag(weights).x, where x is the design matrix described by blocks (cf calibrate)
+    '''
+    gram = zeros((offsets[-1], offsets[-1]))
+    for index_a, ((codes_a, values_a, size_a), offset_a) in enumerate(itertools.izip(blocks, offsets)):
+        weights_a = weights if values_a is None else np.multiply(weights, values_a, out = buffers[0])
+        for (codes_b, values_b, size_b), offset_b in itertools.izip(blocks[index_a:], offsets[index_a:]):
+            weights_ab = weights_a if values_b is None else np.multiply(weights_a, values_b, out = buffers[1])
+            if codes_a is None and codes_b is None:
+                block = weights_ab.sum()
+            elif codes_a is None:
+                block = np.bincount(codes_b, weights = weights_ab, minlength = size_b + 1)[None, :size_b]
+            elif codes_b is None:
+                block = np.bincount(codes_a, weights = weights_ab, minlength = size_a + 1)[:size_a, None]
+            elif codes_b is codes_a:
+                # Each row belongs to a single category of a block: its own block is diagonal.
+                block = np.diag(np.bincount(codes_a, weights = weights_ab, minlength = size_a + 1)[:size_a])
+            else:
+                block = np.bincount(codes_a * (size_b + 1) + codes_b, weights = weights_ab,
+                    minlength = (size_a + 1) * (size_b + 1)).reshape(size_a + 1, size_b + 1)[:size_a, :size_b]
+            gram[offset_a:offset_a + size_a, offset_b:offset_b + size_b] = block
+            gram[offset_b:offset_b + size_b, offset_a:offset_a + size_a] = np.transpose(block)
+    return gram
+
+
+def design_transpose_dot(blocks, weights, buffer):
+    '''
+    Return x'.weights, where x is the design matrix described by blocks (cf calibrate)
+    '''
+    totals = []
+    for codes, values, size in blocks:
+        block_weights = weights if values is None else np.multiply(weights, values, out = buffer)
+        if codes is None:
+            totals.append([block_weights.sum()])
+        else:
+            totals.append(np.bincount(codes, weights = block_weights, minlength = size + 1)[:size])
+    return np.concatenate(totals)
+
+
+def build_categorical_codes(data, var, categories):
+    '''
+    Return the codes of the categories of var (cf build_codes)
+    var is either a variable name, or a tuple of variable names for cross-tabulated margins, whose categories are
+    tuples of values of these variables
+    '''
+    if not isinstance(var, tuple):
+        return build_codes(data[var], categories)
+    # Code each variable separately, then map the combinations of codes to the cross-tabulated categories.
+    components_categories = [
+        sorted(set(category[index] for category in categories))
+        for index in range(len(var))
+        ]
+    shape = tuple(len(component_categories) + 1 for component_categories in components_categories)
+    combined_codes = np.ravel_multi_index([
+        build_codes(data[component], component_categories)
+        for component, component_categories in itertools.izip(var, components_categories)
+        ], shape)
+    categories_combined_codes = np.ravel_multi_index([
+        [component_categories.index(category[index]) for category in categories]
+        for index, component_categories in enumerate(components_categories)
+        ], shape)
+    codes_by_combined_code = np.empty(np.prod(shape), dtype = np.intp)
+    codes_by_combined_code.fill(len(categories))
+    codes_by_combined_code[categories_combined_codes] = np.arange(len(categories))
+    return codes_by_combined_code.take(combined_codes)
+
+
+def build_integer_codes(data, size):
+    '''
+    Return the codes of a variable already coded as integers 0, 1, ..., size - 1 (cf build_codes)
+    '''
+    codes = np.asarray(data)
+    absent = (codes < 0) | (codes >= size)
+    if absent.any() or codes.dtype.kind not in 'iu':
+        codes = codes.astype(np.intp)
+        codes[absent] = size
+    return codes
+
+
+def calibrate(blocks, margins, d, distance, lambda0 = None, maxiter = 100, xtol = 1.49012e-08, ftol = 1e-06):
+    '''
+    Find the Lagrange multipliers lambdas such that x'.(d * F(x.lambdas)) = margins, using Newton's method
+      - blocks describes the design matrix x, without building it: each block is a triple (codes, values, size) giving
+        size columns of x. For each row, the only non null column of the block is the one at position codes (no
+        column when codes == size), and its value is values. codes = None stands for a single column; values = None
+        stands for 1. Thus a categorical variable is a block (codes, None, number of categories) and a numeric variable
+        a block (None, values, 1).
+      - margins is the array of the margins of the columns of x
+      - d is the array of the initial weights
+      - distance computes F(u) and F'(u) in place (cf distance_builder_by_method)
+      - lambda0 is the initial value of lambdas (zeros by default), for example the solution of a similar calibration
+      - the iterations stop when the step or the residuals are negligible (xtol) or after maxiter iterations
+      - the calibration has converged when the residuals, relative to the margins, are below ftol
+    Returns lambdas, the number of iterations, the residuals x'.(d * F(x.lambdas)) - margins and whether it converged
+    '''
+    offsets = np.cumsum([0] + [size for codes, values, size in blocks])
+    nk = len(d)
+    lambdas = zeros(offsets[-1]) if lambda0 is None else array(lambda0, dtype = float64)
+    u = np.empty(nk)
+    weights = np.empty(nk)
+    weights_prime = np.empty(nk)
+    buffers = (np.empty(nk), np.empty(nk))
+
+    def residual(lambdas):
+        design_dot(blocks, offsets, lambdas, u, buffers[0])
+        distance(u, weights, weights_prime)
+        np.multiply(weights, d, out = weights)
+        np.multiply(weights_prime, d, out = weights_prime)
+        return design_transpose_dot(blocks, weights, buffers[0]) - margins
+
+    error = residual(lambdas)
+    iteration = 0
+    for iteration in xrange(1, maxiter + 1):
+        # weights_prime is d * F'(x.lambdas), computed by residual. The margins of a categorical variable sum to the
+        # total population, so the jacobian is singular: use the minimum norm solution.
+        step = np.linalg.lstsq(design_gram(blocks, offsets, weights_prime, buffers), error, rcond = -1)[0]
+        # Halve the Newton step while it doesn't reduce the residual.
+        norm = np.dot(error, error)
+        for halving in xrange(20):
+            new_lambdas = lambdas - step
+            new_error = residual(new_lambdas)
+            if np.dot(new_error, new_error) <= norm:
+                break
+            step /= 2
+        lambdas, error = new_lambdas, new_error
+        if np.abs(step).max() <= xtol * (1 + np.abs(lambdas).max()) \
+                or np.abs(error).max() <= xtol * np.abs(margins).max():
+            break
+    converged = bool(np.all(np.abs(error) <= ftol * np.maximum(np.abs(margins), 1)))
+    return lambdas, iteration, error, converged
+
+
 def calmar(data_in, margins, param = {}, pondini='wprm_init'):
+    '''
+    Calibrates weights according to some margins, cf calibrate_weights
+    Returns the calibrated weights, the Lagrange multipliers and the margins used
+    '''
+    return calibrate_weights(data_in, margins, param = param, pondini = pondini)[:3]
+
+
+def calmar_years(data_by_year, margins_by_year, param = {}, pondini = 'wprm_init'):
+    '''
+    Calibrates the weights of several years, each calibration starting from the Lagrange multipliers of the previous
+    year (cf param lambda0 of calibrate_weights)
+    Returns a dict giving for each year the result of calibrate_weights
+    '''
+    result_by_year = {}
+    lambda_by_var = None
+    for year in sorted(margins_by_year):
+        year_param = dict(param)
+        if lambda_by_var is not None:
+            year_param['lambda0'] = lambda_by_var
+        result_by_year[year] = result = calibrate_weights(data_by_year[year], dict(margins_by_year[year]),
+            param = year_param, pondini = pondini)
+        lambda_by_var = result[3]['lambda_by_var']
+    return result_by_year
+
+
+def calibrate_weights(data_in, margins, param = {}, pondini = 'wprm_init'):
     '''
     Calibraters weights according to some margins
       - data_in is a dict containing individual data
@@ -73,21 +344,41 @@ def calmar(data_in, margins, param = {}, pondini='wprm_init'):
      margins is a dict containing for each var:
       - a scalar var numeric variables
       - a dict with categories key and population
+      - a list of populations, for categorical variables coded as integers 0, 1, ..., n - 1 (no dummy variable is built)
+      - var can be a tuple of variable names, for cross-tabulated margins given as a dict with tuples of categories keys
       - eventually a key named totalpop : total population. If absent initialized to actual total population
      param is a dict containing the following keys
-      - method : 'linear', 'raking ratio', 'logit'
+      - method : 'linear', 'raking ratio', 'logit', 'truncated linear' (cf distance_builder_by_method)
       - lo     : lower bound on weights ratio  <1
       - up     : upper bound on weights ration >1
       - use_proportions : default FALSE; if TRUE use proportions if total population from margins doesn't match total population
-      - param xtol  : relative precision on lagrangian multipliers. By default xtol = 1.49012e-08 (default fsolve xtol)
-      - param maxfev :  maximum number of function evaluation TODO
+      - param xtol  : relative precision on lagrangian multipliers. By default xtol = 1.49012e-08
+      - param maxiter : maximum number of Newton iterations. By default 100
+      - param ftol : maximum relative error on margins of a converged calibration. By default 1e-06
+      - param lambda0 : initial Lagrange multipliers, given as the lambda_by_var of a previous calibration. Missing
+        variables and categories start from 0
+    Returns the calibrated weights, the Lagrange multipliers, the margins used and a dict of diagnostics:
+      - converged : whether the relative errors on margins are below ftol (else a message is printed)
+      - iterations : number of Newton iterations
+      - time : duration of the resolution, in seconds
+      - residual_by_var : relative error on each margin (a dict by category for categorical variables)
+      - lambda_by_var : Lagrange multiplier of each margin (a dict by category for categorical variables)
     '''
+    start_time = time.time()
 
-    # remove null weights and keep original data
-    data = dict()
+    # remove null weights, only for the variables used by the margins
     is_weight_not_null = (data_in[pondini] > 0)
-    for a in data_in:
-        data[a] = data_in[a][is_weight_not_null]
+    if is_weight_not_null.all():
+        data = data_in
+    else:
+        used_vars = set([pondini])
+        for var in margins:
+            if var != 'totalpop':
+                used_vars.update(var if isinstance(var, tuple) else [var])
+        data = dict(
+            (var, data_in[var][is_weight_not_null])
+            for var in used_vars
+            )
 
     if not margins:
         raise Exception("Calmar requires non empty dict of margins")
@@ -96,27 +387,14 @@ def calmar(data_in, margins, param = {}, pondini='wprm_init'):
     if not 'method' in param:
         param['method'] = 'linear'
 
-    if param['method'] == 'linear':
-        F = linear
-        F_prime = linear_prime
-    elif param['method'] == 'raking ratio':
-        F =  raking_ratio
-        F_prime =  raking_ratio_prime
-    elif param['method'] == 'logit':
-        if not 'up' in param:
-            raise Exception("When method is 'logit', 'up' parameter is needed in param")
-        if not 'lo' in param:
-            raise Exception("When method is 'logit', 'lo' parameter is needed in param")
-        if param['up'] <= 1:
-            raise Exception("When method is 'logit', 'up' should be strictly greater than 1")
-        if param['lo'] >= 1:
-            raise Exception("When method is 'logit', 'lo' should be strictly less than 1")
-        F = lambda x: logit(x, param['lo'], param['up'])
-        F_prime = lambda x: logit_prime(x, param['lo'], param['up'])
-
-    else:
-        raise Exception("method should be 'linear', 'raking ratio' or 'logit'")
-    # construction observations matrix
+    distance_builder = distance_builder_by_method.get(param['method'])
+    if distance_builder is None:
+        raise Exception("method should be one of %s" % ', '.join(
+            "'%s'" % method
+            for method in sorted(distance_builder_by_method)
+            ))
+    distance = distance_builder(param)
+    # construction of the blocks of the design matrix
     if 'totalpop' in margins:
         totalpop = margins.pop('totalpop')
     else:
@@ -127,98 +405,155 @@ def calmar(data_in, margins, param = {}, pondini='wprm_init'):
     else:
         use_proportions = False
 
-    nk = len(data[pondini])
-
-    # number of Lagrange parameters (at least total population)
-    nj = 1
-
-    margins_new = {}
+    # On conserve systematiquement la population
+    blocks = [(None, None, 1)]
+    blocks_categories = [None]
+    blocks_var = ['totalpop']
+    xmargins = [totalpop]
     margins_new_dict = {}
     for var, val in margins.iteritems():
         if isinstance(val, dict):
-            dummies_dict = build_dummies_dict(data[var])
-            k, pop = 0, 0
-            for cat, nb in val.iteritems():
-                cat_varname =  var + '_' + str(cat)
-                data[cat_varname] = dummies_dict[cat]
-                margins_new[cat_varname] = nb
-                if not margins_new_dict.has_key(var):
-                    margins_new_dict[var] = {}
-                margins_new_dict[var][cat] = nb
-                pop += nb
-                k += 1
-                nj += 1
-            # Check total popualtion
-            if pop != totalpop:
-                if use_proportions:
-                    print 'calmar: categorical variable %s is inconsistent with population; using proportions' % var
-                    for cat, nb in val.iteritems():
-                        cat_varname =  var + '_' + str(cat)
-                        margins_new[cat_varname] = nb*totalpop/pop
-                        margins_new_dict[var][cat] = nb*totalpop/pop
-                else:
-                    raise Exception('calmar: categorical variable ', var, ' is inconsistent with population')
+            categories = sorted(val)
+            codes = build_categorical_codes(data, var, categories)
+            nbs = array([val[cat] for cat in categories], dtype = float64)
+        elif isinstance(val, (list, tuple, np.ndarray)):
+            # Variable already coded as integers 0, 1, ..., len(val) - 1
+            categories = range(len(val))
+            codes = build_integer_codes(data[var], len(val))
+            nbs = array(val, dtype = float64)
         else:
-            margins_new[var] = val
+            blocks.append((None, array(data[var], dtype = float64), 1))
+            blocks_categories.append(None)
+            blocks_var.append(var)
+            xmargins.append(val)
             margins_new_dict[var] = val
-            nj += 1
-
-    # On conserve systematiquement la population
-    if  hasattr(data,'dummy_is_in_pop'):
-        raise Exception('dummy_is_in_pop is not a valid variable name')
-
-    data['dummy_is_in_pop'] = ones(nk)
-    margins_new['dummy_is_in_pop'] = totalpop
-
-    # paramètres de Lagrange initialisés à zéro
-    lambda0 = zeros(nj)
-
-    # initial weights
-    d = data[pondini]
-    x = zeros((nk, nj)) # nb obs x nb constraints
-    xmargins = zeros(nj)
-    margins_dict = {}
-    j=0
-    for var , val in margins_new.iteritems():
-        x[:,j] = data[var]
-        xmargins[j] = val
-        margins_dict[var] =val
-        j += 1
+            continue
+        for cat, count in itertools.izip(categories, np.bincount(codes, minlength = len(categories) + 1)):
+            if count == 0:
+                raise Exception('calmar: category %s of variable %s is absent from data' % (cat, var))
+        # Check total popualtion
+        pop = nbs.sum()
+        if pop != totalpop:
+            if use_proportions:
+                print 'calmar: categorical variable %s is inconsistent with population; using proportions' % (var,)
+                nbs *= totalpop / pop
+            else:
+                raise Exception('calmar: categorical variable ', var, ' is inconsistent with population')
+        margins_new_dict[var] = dict(itertools.izip(categories, nbs)) if isinstance(val, dict) else nbs
+        blocks.append((codes, None, len(categories)))
+        blocks_categories.append(categories)
+        blocks_var.append(var)
+        xmargins.extend(nbs)
+    xmargins = array(xmargins, dtype = float64)
+    offsets = np.cumsum([0] + [block[2] for block in blocks])
+
+    lambda0 = zeros(offsets[-1])
+    lambda0_by_var = param.get('lambda0') or {}
+    for var, categories, offset in itertools.izip(blocks_var, blocks_categories, offsets):
+        var_lambda0 = lambda0_by_var.get(var)
+        if var_lambda0 is None:
+            continue
+        if categories is None:
+            lambda0[offset] = var_lambda0
+        else:
+            lambda0[offset:offset + len(categories)] = [var_lambda0.get(cat, 0) for cat in categories]
 
     # Résolution des équations du premier ordre
-    constraint = lambda l: dot(d*F(dot(x, l)), x) - xmargins
-    constraint_prime = lambda l: dot(d*(x.T*F_prime(dot(x, l))), x)
-    ## le jacobien celui ci-dessus est constraintprime = @(l) x*(d.*Fprime(x'*l)*x');
-
-    essai, ier = 0, 2
-    if 'xtol' in param:
-        xtol = param['xtol']
-    else:
-        xtol = 1.49012e-08
-
-    err_max = 1
-    conv = 1
-    while (ier==2 or ier==5 or ier==4) and not (essai >= 10 or (err_max < 1e-6 and conv < 1e-8)):
-        lambdasol, infodict, ier, mesg = fsolve(constraint, lambda0, fprime=constraint_prime, maxfev= 256, xtol=xtol, full_output=1)
-        lambda0 = 1*lambdasol
-        essai += 1
+    d = array(data[pondini], dtype = float64)
+    maxiter = param.get('maxiter', 100)
+    lambdasol, iterations, error, converged = calibrate(blocks, xmargins, d, distance, lambda0 = lambda0,
+        maxiter = maxiter, xtol = param.get('xtol', 1.49012e-08), ftol = param.get('ftol', 1e-06))
+    if not converged:
+        print "calmar: no convergence after", iterations, "iterations; maximum relative error on margins:", \
+            np.abs(error / xmargins).max()
+
+    u = design_dot(blocks, offsets, lambdasol, np.empty(len(d)), np.empty(len(d)))
+    pondfin = np.empty(len(d))
+    distance(u, pondfin, np.empty(len(d)))
+    pondfin *= d
 
-        pondfin = d*F(dot(x, lambdasol))
-        rel_error ={}
-        for var, val in margins_new.iteritems():
-            rel_error[var] =  abs((data[var]*pondfin).sum() - margins_dict[var])/margins_dict[var]
-        sorted_err = sorted(rel_error.iteritems(), key=operator.itemgetter(1), reverse = True)
+    # rebuilding a weight vector with the same size of the initial one
+    pondfin_out = array(data_in[pondini], dtype=float64)
+    pondfin_out[is_weight_not_null] = pondfin
 
-        conv = abs(err_max - sorted_err[0][1])
-        err_max = sorted_err[0][1]
+    relative_error = error / xmargins
+    lambda_by_var = {}
+    residual_by_var = {}
+    for var, categories, offset in itertools.izip(blocks_var, blocks_categories, offsets):
+        if categories is None:
+            lambda_by_var[var] = lambdasol[offset]
+            residual_by_var[var] = relative_error[offset]
+        else:
+            lambda_by_var[var] = dict(itertools.izip(categories, lambdasol[offset:offset + len(categories)]))
+            residual_by_var[var] = dict(itertools.izip(categories, relative_error[offset:offset + len(categories)]))
+    diagnostics = dict(
+        converged = converged,
+        iterations = iterations,
+        lambda_by_var = lambda_by_var,
+        residual_by_var = residual_by_var,
+        time = time.time() - start_time,
+        )
 
-    if (ier==2 or ier==5 or ier==4):
-        print "calmar: stopped after ", essai, "tries"
+    return pondfin_out, lambdasol, margins_new_dict, diagnostics
 
 
-    # rebuilding a weight vector with the same size of the initial one
-    pondfin_out = array(data_in[pondini], dtype=float64)
-    pondfin_out[is_weight_not_null] = pondfin
+def calmar_simulation(simulation, margins, param = {}, weight_name = None, initial_weight_name = None):
+    '''
+    Calibrates the weights of a simulation, according to margins of variables of any entity
+      - the weights are the column weight_name (model.WEIGHT by default), calibrated from the column
+        initial_weight_name (model.WEIGHT_INI by default). The calibrated weights are stored in the simulation
+      - margins are given as in calmar. The variables of other entities than the one of the weights are aggregated to
+        it, using the id columns of the individuals: for example, with household weights, a margin of the number of
+        individuals by age group
+    Returns the result of calibrate_weights
+    '''
+    if weight_name is None:
+        weight_name = model.WEIGHT
+    if initial_weight_name is None:
+        initial_weight_name = model.WEIGHT_INI
+    weight_entity = simulation.entity_by_column_name[weight_name]
+    data = {initial_weight_name: simulation.compute(initial_weight_name)}
+    weight_margins = {}
+    for var, val in margins.iteritems():
+        if var == 'totalpop':
+            weight_margins[var] = val
+            continue
+        entity = simulation.entity_by_column_name[var]
+        if entity is weight_entity:
+            data[var] = simulation.compute(var)
+            weight_margins[var] = val
+            continue
+        weight_index = get_weight_index(simulation, entity, weight_entity)
+        values = simulation.compute(var)
+        if isinstance(val, (dict, list, tuple, np.ndarray)):
+            # The margin of each category becomes the margin of a numeric variable: the count of members of the
+            # category in each row of the weight entity.
+            for cat, nb in (val.iteritems() if isinstance(val, dict) else enumerate(val)):
+                cat_var = '%s_%s' % (var, cat)
+                data[cat_var] = np.bincount(weight_index, weights = values == cat, minlength = weight_entity.count)
+                weight_margins[cat_var] = nb
+        else:
+            data[var] = np.bincount(weight_index, weights = values, minlength = weight_entity.count)
+            weight_margins[var] = val
+    result = calibrate_weights(data, weight_margins, param = param, pondini = initial_weight_name)
+    weight_holder = simulation.get_or_new_holder(weight_name)
+    weight_holder.array = result[0].astype(weight_holder.column._dtype)
+    return result
 
-    return pondfin_out, lambdasol, margins_new_dict
 
+def get_weight_index(simulation, entity, weight_entity):
+    '''
+    Return the position in weight_entity of each member of entity
+    A member of another group entity belongs to the weight entity row of its head (qui == 0).
+    '''
+    individus = simulation.entities['individus']
+    if weight_entity is individus:
+        individus_weight_index = np.arange(individus.count)
+    else:
+        individus_weight_index = simulation.compute('id' + weight_entity.symbol)
+    if entity is individus:
+        return individus_weight_index
+    heads = simulation.compute('qui' + entity.symbol) == 0
+    weight_index = np.empty(entity.count, dtype = individus_weight_index.dtype)
+    weight_index[simulation.compute('id' + entity.symbol)[heads]] = individus_weight_index[heads]
+    return weight_index
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Dependency graph between columns, computed once and shared by every tax-benefit system using the same columns."""
+
+
+from bisect import bisect_left, bisect_right
+import collections
+import threading
+
+import numpy as np
+
+
+__all__ = ['DependencyGraph', 'get_dependency_graph']
+
+
+# LRU cache of the dependency graphs, by id of the column_by_name dict. Each entry keeps its dict, so that the id can't
+# be reused by another dict while the entry exists.
+dependency_graph_cache = collections.OrderedDict()
+dependency_graph_cache_lock = threading.Lock()
+max_dependency_graph_cache_size = 16
+
+
+class DependencyGraph(object):
+    """Immutable dependency graph of a set of columns.
+
+    Columns are numbered in the order of their names. The parents (inputs) and children of each column are stored as
+    compressed adjacency arrays, and the columns disabled at a date are cached by validity window, ie by the position
+    of the date among the start and end dates of the columns.
+
+    The graph never modifies the columns: the calculated and disabled flags of a tax-benefit system are boolean arrays
+    indexed like the columns (cf new_flags).
+    """
+    __slots__ = ('_disabled_by_window', '_ends', '_ends_index', '_starts', '_starts_index', 'children_index',
+        'children_indptr', 'columns', 'index_by_name', 'parents_index', 'parents_indptr', 'primitives')
+
+    def __init__(self, column_by_name):
+        names = sorted(column_by_name)
+        columns = tuple(column_by_name[name] for name in names)
+        index_by_name = dict((name, index) for index, name in enumerate(names))
+
+        parents = []
+        primitives = set()
+        for column in columns:
+            column_parents = set()
+            for input_name in column.inputs:
+                input_index = index_by_name.get(input_name)
+                if input_index is None:
+                    primitives.add(input_name)
+                else:
+                    column_parents.add(input_index)
+            parents.append(sorted(column_parents))
+        parents_count = np.array([len(parent_indexes) for parent_indexes in parents], dtype = np.intp)
+        parents_indptr = np.concatenate(([0], np.cumsum(parents_count)))
+        parents_index = np.array([index for parent_indexes in parents for index in parent_indexes], dtype = np.intp)
+
+        # Children are the transpose of parents: sort the edges by parent.
+        edges_child = np.repeat(np.arange(len(columns), dtype = np.intp), parents_count)
+        order = np.argsort(parents_index, kind = 'mergesort')
+        children_index = edges_child[order]
+        children_indptr = np.concatenate(([0], np.cumsum(np.bincount(parents_index, minlength = len(columns)))))
+
+        for array in (parents_index, parents_indptr, children_index, children_indptr):
+            array.flags.writeable = False
+        object.__setattr__(self, 'children_index', children_index)
+        object.__setattr__(self, 'children_indptr', children_indptr)
+        object.__setattr__(self, 'columns', columns)
+        object.__setattr__(self, 'index_by_name', index_by_name)
+        object.__setattr__(self, 'parents_index', parents_index)
+        object.__setattr__(self, 'parents_indptr', parents_indptr)
+        object.__setattr__(self, 'primitives', frozenset(primitives))
+
+        starts = sorted((column.start, index) for index, column in enumerate(columns) if column.start is not None)
+        ends = sorted((column.end, index) for index, column in enumerate(columns) if column.end is not None)
+        object.__setattr__(self, '_starts', [start for start, index in starts])
+        object.__setattr__(self, '_starts_index', np.array([index for start, index in starts], dtype = np.intp))
+        object.__setattr__(self, '_ends', [end for end, index in ends])
+        object.__setattr__(self, '_ends_index', np.array([index for end, index in ends], dtype = np.intp))
+        object.__setattr__(self, '_disabled_by_window', {})
+
+    def __delattr__(self, name):
+        raise AttributeError('DependencyGraph is immutable')
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DependencyGraph is immutable')
+
+    def get_children(self, name):
+        index = self.index_by_name[name]
+        columns = self.columns
+        return tuple(
+            columns[child_index]
+            for child_index in self.children_index[self.children_indptr[index]:self.children_indptr[index + 1]]
+            )
+
+    def get_disabled(self, date):
+        """Return the (read-only) boolean array of the columns disabled at date, ie not valid at this date."""
+        # Columns starting after date are the last ones in _starts, columns ending before date are the first in _ends.
+        window = (bisect_right(self._starts, date), bisect_left(self._ends, date))
+        disabled = self._disabled_by_window.get(window)
+        if disabled is None:
+            disabled = np.zeros(len(self.columns), dtype = bool)
+            disabled[self._starts_index[window[0]:]] = True
+            disabled[self._ends_index[:window[1]]] = True
+            disabled.flags.writeable = False
+            self._disabled_by_window[window] = disabled
+        return disabled
+
+    def get_parents(self, name):
+        index = self.index_by_name[name]
+        columns = self.columns
+        return tuple(
+            columns[parent_index]
+            for parent_index in self.parents_index[self.parents_indptr[index]:self.parents_indptr[index + 1]]
+            )
+
+    def new_flags(self):
+        """Return a new array of flags (all False) indexed like the columns."""
+        return np.zeros(len(self.columns), dtype = bool)
+
+
+def get_dependency_graph(column_by_name):
+    """Return the dependency graph of the columns, building it only the first time this dict of columns is used.
+
+    The graph is built again when the columns of the dict have changed since.
+    """
+    key = id(column_by_name)
+    with dependency_graph_cache_lock:
+        entry = dependency_graph_cache.pop(key, None)
+    if entry is not None:
+        cached_column_by_name, dependency_graph = entry
+        if cached_column_by_name is not column_by_name or len(column_by_name) != len(dependency_graph.columns) \
+                or any(
+                    column_by_name.get(name) is not dependency_graph.columns[index]
+                    for name, index in dependency_graph.index_by_name.iteritems()
+                    ):
+            dependency_graph = None
+    else:
+        dependency_graph = None
+    if dependency_graph is None:
+        dependency_graph = DependencyGraph(column_by_name)
+    with dependency_graph_cache_lock:
+        dependency_graph_cache[key] = (column_by_name, dependency_graph)
+        while len(dependency_graph_cache) > max_dependency_graph_cache_size:
+            dependency_graph_cache.popitem(last = False)
+    return dependency_graph
@@ -111,6 +111,6 @@ class SimpleFormula(Formula):
         assert provided_parameters == required_parameters, 'Formula {} requires missing parameters : {}'.format(
             u', '.join(sorted(required_parameters - provided_parameters)).encode('utf-8'))
 
-        holder.array = self.calculate(**arguments)
+        holder.array = holder.computed_array = self.calculate(**arguments)
         requested_columns_name.remove(holder.column.name)
         return holder.array
@@ -31,6 +31,7 @@ from . import columns
 class Holder(object):
     array = None
     column = None
+    computed_array = None  # Array computed by the formula or filled by default, to distinguish it from an input array
     entity = None
     formula = None
 
@@ -45,16 +46,18 @@ class Holder(object):
 
     def compute(self, requested_columns_name):
         column = self.column
-        date = self.entity.simulation.date
-        if column.start is not None and column.start > date or column.end is not None and column.end < date:
+        simulation = self.entity.simulation
+        date = simulation.date
+        if column.start is not None and column.start > date or column.end is not None and column.end < date \
+                or column.name in simulation.disabled_columns_name:
             if self.array is None:
-                self.array = np.empty(self.entity.count, dtype = column._dtype)
+                self.array = self.computed_array = np.empty(self.entity.count, dtype = column._dtype)
                 self.array.fill(column._default)
             return self.array
         formula = self.formula
         if formula is None:
             if self.array is None:
-                self.array = np.empty(self.entity.count, dtype = column._dtype)
+                self.array = self.computed_array = np.empty(self.entity.count, dtype = column._dtype)
                 self.array.fill(column._default)
             return self.array
         return formula(requested_columns_name)
@@ -62,4 +65,5 @@ class Holder(object):
     def copy_for_entity(self, entity):
         new = self.__class__(column = self.column, entity = entity)
         new.array = self.array
+        new.computed_array = self.computed_array
         return new
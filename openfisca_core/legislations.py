@@ -27,11 +27,16 @@
 
 
 import collections
+import copy
 import datetime
+import hashlib
 import itertools
+import re
+
+import numpy as np
 
 from . import conv
-from baremes import Bareme
+from baremes import Bareme, build_bareme, CompiledBareme, VectorialBareme
 
 
 units = [
@@ -43,6 +48,11 @@ units = [
     ]
 
 
+fragments_by_path = {}  # Cache of interned attribute names for each dotted path
+identifier_re = re.compile(r'[A-Za-z_][A-Za-z0-9_]*$')
+frozen_compact_node_class_by_children_name = {}
+
+
 class CompactNode(object):
     datesim = None
     # Other attributes coming from dated_node_json are not defined in class.
@@ -50,6 +60,187 @@ class CompactNode(object):
     def __repr__(self):
         return 'CompactNode({})'.format(repr(self.__dict__))
 
+    def freeze(self):
+        """Return an immutable copy of this node, whose children are stored in slots.
+
+        Baremes stay Bareme instances, for the formulas using their (mutable) API, but they are compiled now: their
+        calc uses the cached CompiledBareme.
+        """
+        items = []
+        for name, value in self.__dict__.iteritems():
+            if isinstance(value, CompactNode):
+                value = value.freeze()
+            elif isinstance(value, Bareme):
+                value.compile()
+            items.append((name, value))
+        return new_frozen_compact_node(items)
+
+    def get_by_path(self, path):
+        return get_compact_node_value_by_path(self, path)
+
+    def iteritems(self):
+        return self.__dict__.iteritems()
+
+
+class FrozenCompactNode(object):
+    """Immutable compact node
+
+    Each distinct set of children names gets its own subclass, whose ``__slots__`` are these names, so that instances
+    have no ``__dict__`` and attribute lookups are plain slot reads. Children names must therefore be identifiers and
+    must not hide the attributes of FrozenCompactNode (cf new_frozen_compact_node).
+
+    Pickling flattens the tree into a tuple of interned dotted paths and a float array of the scalar parameters, which
+    is much smaller and faster to load than the pickle of nested objects.
+    """
+    __slots__ = ('__weakref__', '_fingerprint', '_flat')
+    datesim = None
+
+    def __delattr__(self, name):
+        raise AttributeError('FrozenCompactNode is immutable: {} can not be deleted'.format(name))
+
+    def __reduce__(self):
+        return (unflatten_compact_node, self.flatten())
+
+    def __repr__(self):
+        return 'FrozenCompactNode({})'.format(repr(dict(self.iteritems())))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('FrozenCompactNode is immutable: {} can not be set'.format(name))
+
+    def flatten(self):
+        """Return ``(scalar_paths, scalar_values, other_paths, other_values)`` describing the leaves of the tree.
+
+        ``scalar_values`` is a float array containing the float parameters, in the order of ``scalar_paths``. The other
+        leaves (integers, booleans, baremes, dates, etc) are given in ``other_values``.
+        """
+        flat = getattr(self, '_flat', None)
+        if flat is None:
+            scalar_paths = []
+            scalar_values = []
+            other_paths = []
+            other_values = []
+            for path, value in iter_compact_node_leaves(self):
+                if type(value) is float:
+                    scalar_paths.append(path)
+                    scalar_values.append(value)
+                else:
+                    other_paths.append(path)
+                    other_values.append(value)
+            flat = (tuple(scalar_paths), np.array(scalar_values, dtype = np.float64), tuple(other_paths),
+                tuple(other_values))
+            object.__setattr__(self, '_flat', flat)
+        return flat
+
+    def fingerprint(self):
+        """Return a hash of the parameters of the legislation, stable across processes, for example to key caches."""
+        fingerprint = getattr(self, '_fingerprint', None)
+        if fingerprint is None:
+            scalar_paths, scalar_values, other_paths, other_values = self.flatten()
+            sha1 = hashlib.sha1()
+            sha1.update(u'\n'.join(scalar_paths).encode('utf-8'))
+            sha1.update(scalar_values.tostring())
+            for path, value in itertools.izip(other_paths, other_values):
+                sha1.update(u'\n{}='.format(path).encode('utf-8'))
+                if isinstance(value, (Bareme, CompiledBareme)):
+                    value = value.compile()
+                    sha1.update(value.seuils_array.tostring())
+                    sha1.update(value.taux_array.tostring())
+                    if value._linear_taux_moy:
+                        sha1.update(value.tauxM_array.tostring())
+                else:
+                    sha1.update(repr(value))
+            fingerprint = sha1.hexdigest()
+            object.__setattr__(self, '_fingerprint', fingerprint)
+        return fingerprint
+
+    def freeze(self):
+        return self
+
+    def get_by_path(self, path):
+        return get_compact_node_value_by_path(self, path)
+
+    def get_scalar_index(self):
+        """Return a dict giving the position of each scalar parameter path in the array of scalar values."""
+        scalar_paths = self.flatten()[0]
+        return dict((path, index) for index, path in enumerate(scalar_paths))
+
+    def iteritems(self):
+        for name in self.__slots__:
+            yield name, getattr(self, name)
+
+    def thaw(self):
+        """Return a mutable copy of this node, for example to modify it in a reform."""
+        compact_node = CompactNode()
+        compact_node_dict = compact_node.__dict__
+        for name, value in self.iteritems():
+            if isinstance(value, FrozenCompactNode):
+                value = value.thaw()
+            elif isinstance(value, Bareme):
+                value = copy.deepcopy(value)
+            elif isinstance(value, CompiledBareme):
+                value = value.to_bareme()
+            compact_node_dict[name] = value
+        return compact_node
+
+
+class VectorialCompactNode(object):
+    """Compact legislation whose parameters are arrays, giving for each row the value in force at the row's date
+
+    ``compact_nodes`` is a sequence of compact nodes (for example one per distinct date or period) and ``index`` is an
+    integer array giving, for each row, the position of its compact node in ``compact_nodes``.
+
+    Leaves are computed when they are accessed: numbers are returned as arrays of the size of ``index`` (``nan`` when
+    the parameter doesn't exist at a date) and scales as ``VectorialBareme`` instances.
+    """
+    _child_by_name = None
+    _rows_by_position = None
+    compact_nodes = None
+    index = None
+
+    def __init__(self, compact_nodes, index, rows_by_position = None):
+        self._child_by_name = {}
+        self._rows_by_position = rows_by_position
+        self.compact_nodes = compact_nodes
+        self.index = index
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        child = self._child_by_name.get(name)
+        if child is None:
+            values = [
+                getattr(compact_node, name, None) if compact_node is not None else None
+                for compact_node in self.compact_nodes
+                ]
+            if all(value is None for value in values):
+                raise AttributeError(name)
+            if any(isinstance(value, (CompactNode, FrozenCompactNode)) for value in values):
+                child = VectorialCompactNode(values, self.index, rows_by_position = self.rows_by_position)
+            elif any(isinstance(value, (Bareme, CompiledBareme)) for value in values):
+                child = VectorialBareme(values, self.index, rows_by_position = self.rows_by_position)
+            elif any(value is None for value in values):
+                child = np.array([np.nan if value is None else value for value in values], dtype = np.float64)
+            else:
+                child = np.array(values)
+            self._child_by_name[name] = child
+        if isinstance(child, np.ndarray):
+            return child.take(self.index)
+        return child
+
+    def __repr__(self):
+        return 'VectorialCompactNode({})'.format(repr(self.compact_nodes))
+
+    def get_by_path(self, path):
+        return get_compact_node_value_by_path(self, path)
+
+    @property
+    def rows_by_position(self):
+        """List giving for each compact node the array of the rows that use it"""
+        rows_by_position = self._rows_by_position
+        if rows_by_position is None:
+            rows_by_position = self._rows_by_position = group_rows_by_index(self.index, len(self.compact_nodes))
+        return rows_by_position
+
 
 # Functions
 
@@ -68,17 +259,102 @@ def compact_dated_node_json(dated_node_json, code = None):
     if node_type == u'Parameter':
         return dated_node_json.get('value')
     assert node_type == u'Scale'
-    bareme = Bareme(name = code, option = dated_node_json.get('option'))
+    thresholds = []
+    rates = []
     for dated_slice_json in dated_node_json['slices']:
         base = dated_slice_json.get('base', 1)
         rate = dated_slice_json.get('rate')
         threshold = dated_slice_json.get('threshold')
         if rate is not None and threshold is not None:
-            bareme.addTranche(threshold, rate * base)
+            thresholds.append(threshold)
+            rates.append(rate * base)
+    bareme = build_bareme(thresholds, rates, name = code, option = dated_node_json.get('option'))
     bareme.marToMoy()
     return bareme
 
 
+def get_compact_node_value_by_path(compact_node, path):
+    """Return the value of a (frozen or not) compact node at the given dotted path (for example ``"ir.bareme"``)."""
+    fragments = fragments_by_path.get(path)
+    if fragments is None:
+        fragments_by_path[path] = fragments = tuple(intern(str(fragment)) for fragment in path.split('.'))
+    value = compact_node
+    for fragment in fragments:
+        value = getattr(value, fragment)
+    return value
+
+
+def group_rows_by_index(index, count):
+    """Return a list giving, for each position in ``range(count)``, the sorted array of the rows of ``index`` equal to
+    it.
+
+    Uses a single stable sort of ``index``, instead of one boolean mask per position.
+    """
+    order = np.argsort(index, kind = 'mergesort')
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(index, minlength = count))))
+    return [
+        order[start:stop]
+        for start, stop in itertools.izip(bounds[:-1], bounds[1:])
+        ]
+
+
+def iter_compact_node_leaves(compact_node, prefix = None):
+    """Iterate over the ``(path, value)`` couples of the leaves of a compact node."""
+    for name, value in compact_node.iteritems():
+        path = name if prefix is None else intern('{}.{}'.format(prefix, name))
+        if isinstance(value, (CompactNode, FrozenCompactNode)) and list(value.iteritems()):
+            for leaf in iter_compact_node_leaves(value, prefix = path):
+                yield leaf
+        else:
+            yield path, value
+
+
+def new_frozen_compact_node(items):
+    items = sorted(items)
+    for name, value in items:
+        if not isinstance(name, basestring) or identifier_re.match(name) is None:
+            raise ValueError(u'Legislation parameter name {!r} is not an identifier: it can not be frozen'.format(
+                name).encode('utf-8'))
+        if name != 'datesim' and hasattr(FrozenCompactNode, name):
+            raise ValueError('Legislation parameter name {} hides an attribute of FrozenCompactNode'.format(name))
+    items = [(intern(str(name)), value) for name, value in items]
+    children_name = tuple(name for name, value in items)
+    node_class = frozen_compact_node_class_by_children_name.get(children_name)
+    if node_class is None:
+        node_class = type('FrozenCompactNode', (FrozenCompactNode,), dict(__slots__ = children_name))
+        frozen_compact_node_class_by_children_name[children_name] = node_class
+    node = node_class.__new__(node_class)
+    for name, value in items:
+        object.__setattr__(node, name, value)
+    return node
+
+
+def unflatten_compact_node(scalar_paths, scalar_values, other_paths, other_values):
+    """Rebuild a frozen compact node from the result of its ``flatten()`` method."""
+    tree = {}
+    for path, value in itertools.chain(
+            itertools.izip(scalar_paths, scalar_values.tolist()),
+            itertools.izip(other_paths, other_values),
+            ):
+        fragments = fragments_by_path.get(path)
+        if fragments is None:
+            fragments_by_path[path] = fragments = tuple(intern(str(fragment)) for fragment in path.split('.'))
+        node = tree
+        for fragment in fragments[:-1]:
+            node = node.setdefault(fragment, {})
+        node[fragments[-1]] = value
+
+    def freeze_tree(tree):
+        return new_frozen_compact_node(
+            (name, freeze_tree(value) if isinstance(value, dict) else value)
+            for name, value in tree.iteritems()
+            )
+
+    compact_node = freeze_tree(tree)
+    object.__setattr__(compact_node, '_flat', (scalar_paths, scalar_values, other_paths, other_values))
+    return compact_node
+
+
 def generate_dated_json_value(values_json, date_str, from_str, to_str):
     max_to_str = None
     max_value = None
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Service computing test cases asynchronously, for use by web servers."""
+
+
+import sys
+import threading
+
+import numpy as np
+try:
+    from concurrent.futures import Future, ThreadPoolExecutor
+except ImportError:
+    Future = None
+    ThreadPoolExecutor = None
+
+from . import simulations
+
+
+__all__ = ['SimulationService']
+
+
+class SimulationService(object):
+    """Compute test cases in an executor, returning futures.
+
+    Identical requests waiting to be computed share the same future. Requests arriving within batch_delay seconds and
+    giving the same input columns are computed together: their input arrays are concatenated and computed in a single
+    vectorized simulation, taken from a pool of simulation skeletons by batch shape (cf simulations.SimulationPool).
+    When a batch fails, its requests are computed again one by one, so that a bad request only fails its own future.
+
+    A test case is given as a dict of input arrays by column name and a dict of counts by entity name (missing
+    entities have no member). The result is a dict of arrays by column name, shared by the identical requests: it
+    must not be modified.
+
+    Requires the concurrent.futures module (standard in Python 3, "futures" package in Python 2). The executor must be
+    a thread executor (ThreadPoolExecutor by default), because the batches are computed by methods of the service,
+    which holds a lock and the pool. With asyncio, use asyncio.wrap_future to await the returned futures.
+    """
+    batch_delay = None  # Seconds to wait for other requests before computing a batch
+    entity_class_by_name = None
+    entity_name_by_column_name = None
+    executor = None
+    future_by_key = None  # Futures of the requests not yet computed
+    lock = None
+    max_batch_size = None
+    pending_requests = None  # (key, future, array_by_column_name, count_by_entity_name, columns_name) not yet sent
+    pool = None
+    timer = None
+
+    def __init__(self, batch_delay = 0.005, compact_legislation = None, date = None, disabled_columns_name = None,
+            entity_class_by_name = None, executor = None, max_batch_size = 256, tax_benefit_system = None):
+        assert Future is not None, 'SimulationService requires the concurrent.futures module'
+        self.batch_delay = batch_delay
+        self.entity_class_by_name = entity_class_by_name
+        self.entity_name_by_column_name = dict(
+            (column_name, entity_name)
+            for entity_name, entity_class in entity_class_by_name.iteritems()
+            for column_name in entity_class.column_by_name
+            )
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers = 1)
+        self.future_by_key = {}
+        self.lock = threading.Lock()
+        self.max_batch_size = max_batch_size
+        self.pending_requests = []
+        if compact_legislation is None:
+            # Resolve the legislation once, because the batched simulations must share it.
+            compact_legislation = tax_benefit_system.get_compact_legislation(date)
+        self.pool = simulations.SimulationPool(compact_legislation = compact_legislation, date = date,
+            disabled_columns_name = disabled_columns_name, entity_class_by_name = entity_class_by_name,
+            tax_benefit_system = tax_benefit_system)
+
+    def check_request(self, array_by_column_name, count_by_entity_name, columns_name):
+        """Raise a ValueError when a request is not valid, so that it is never batched with others."""
+        for entity_name, count in count_by_entity_name.iteritems():
+            if entity_name not in self.entity_class_by_name:
+                raise ValueError('Unknown entity: {}'.format(entity_name))
+            if count < 0:
+                raise ValueError('Negative count for entity {}'.format(entity_name))
+        for column_name in columns_name:
+            if column_name not in self.entity_name_by_column_name:
+                raise ValueError('Unknown column: {}'.format(column_name))
+        for column_name, array in array_by_column_name.iteritems():
+            entity_name = self.entity_name_by_column_name.get(column_name)
+            if entity_name is None:
+                raise ValueError('Unknown column: {}'.format(column_name))
+            if np.shape(array) != (count_by_entity_name.get(entity_name, 0),):
+                raise ValueError('Wrong length for column {}'.format(column_name))
+        # Once batched, an id out of its entity would refer to the entity of another request.
+        for entity_name, entity_class in self.entity_class_by_name.iteritems():
+            if entity_name == 'individus':
+                continue
+            id_array = array_by_column_name.get('id' + entity_class.symbol)
+            if id_array is not None:
+                id_array = np.asarray(id_array)
+                if id_array.dtype.kind not in 'biu' and not np.array_equal(id_array, np.floor(id_array)) \
+                        or len(id_array) and (id_array.min() < 0 or id_array.max() >= count_by_entity_name.get(
+                            entity_name, 0)):
+                    raise ValueError('Column id{} must contain integers from 0 to the count of entity {} - 1'.format(
+                        entity_class.symbol, entity_name))
+            qui_array = array_by_column_name.get('qui' + entity_class.symbol)
+            if qui_array is not None:
+                qui_array = np.asarray(qui_array)
+                if qui_array.dtype.kind not in 'biu' and not np.array_equal(qui_array, np.floor(qui_array)) \
+                        or len(qui_array) and qui_array.min() < 0:
+                    raise ValueError('Column qui{} must contain non-negative integer roles'.format(
+                        entity_class.symbol))
+                if id_array is not None and len(set(zip(id_array.tolist(), qui_array.tolist()))) != len(id_array):
+                    raise ValueError('Two members of the same {} have the same role in column qui{}'.format(
+                        entity_name, entity_class.symbol))
+
+    def compute_async(self, array_by_column_name, count_by_entity_name, columns_name):
+        """Return a future of the dict of the arrays of the columns computed for the test case."""
+        try:
+            self.check_request(array_by_column_name, count_by_entity_name, columns_name)
+        except ValueError as exception:
+            future = Future()
+            future.set_exception(exception)
+            return future
+        columns_name = tuple(sorted(columns_name))
+        count_by_entity_name = dict(
+            (entity_name, count_by_entity_name.get(entity_name, 0))
+            for entity_name in self.entity_class_by_name
+            )
+        key = (
+            tuple(sorted(count_by_entity_name.iteritems())),
+            tuple(
+                (column_name, np.asarray(array).tostring())
+                for column_name, array in sorted(array_by_column_name.iteritems())
+                ),
+            columns_name,
+            )
+        with self.lock:
+            future = self.future_by_key.get(key)
+            if future is not None:
+                return future
+            self.future_by_key[key] = future = Future()
+            self.pending_requests.append((key, future, array_by_column_name, count_by_entity_name, columns_name))
+            if len(self.pending_requests) >= self.max_batch_size:
+                self.flush_locked()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.batch_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        return future
+
+    def compute_batch(self, requests):
+        # A column given as input by some requests and computed by the others can't be batched: group the requests
+        # by input columns.
+        requests_by_input_columns_name = {}
+        for request in requests:
+            requests_by_input_columns_name.setdefault(frozenset(request[2]), []).append(request)
+        for group_requests in requests_by_input_columns_name.itervalues():
+            try:
+                array_by_column_name_list = self.compute_test_cases(group_requests)
+            except Exception:
+                if len(group_requests) == 1:
+                    self.set_exception(group_requests[0])
+                    continue
+                # Find the bad requests by computing them alone.
+                for request in group_requests:
+                    try:
+                        array_by_column_name = self.compute_test_cases([request])[0]
+                    except Exception:
+                        self.set_exception(request)
+                    else:
+                        self.set_result(request, array_by_column_name)
+                continue
+            for request, array_by_column_name in zip(group_requests, array_by_column_name_list):
+                self.set_result(request, array_by_column_name)
+
+    def compute_test_cases(self, requests):
+        """Compute requests giving the same input columns, in a simulation made of all their entities."""
+        first_array_by_column_name = requests[0][2]
+        offsets_by_entity_name = dict(
+            (entity_name, np.cumsum([0] + [
+                count_by_entity_name[entity_name]
+                for key, future, array_by_column_name, count_by_entity_name, columns_name in requests
+                ]))
+            for entity_name in self.entity_class_by_name
+            )
+        batch_array_by_column_name = dict(
+            (column_name, np.concatenate([
+                np.asarray(array_by_column_name[column_name])
+                for key, future, array_by_column_name, count_by_entity_name, columns_name in requests
+                ]))
+            for column_name in first_array_by_column_name
+            )
+        # Individuals must refer to the entities of their own test case.
+        individus_counts = np.diff(offsets_by_entity_name['individus'])
+        for entity_name, entity_class in self.entity_class_by_name.iteritems():
+            id_array = batch_array_by_column_name.get('id' + entity_class.symbol)
+            if entity_name != 'individus' and id_array is not None:
+                batch_array_by_column_name['id' + entity_class.symbol] = id_array + np.repeat(
+                    offsets_by_entity_name[entity_name][:-1], individus_counts)
+        batch_count_by_entity_name = dict(
+            (entity_name, offsets[-1])
+            for entity_name, offsets in offsets_by_entity_name.iteritems()
+            )
+        batch_columns_name = sorted(set(
+            column_name
+            for key, future, array_by_column_name, count_by_entity_name, columns_name in requests
+            for column_name in columns_name
+            ))
+
+        with self.lock:
+            simulation = self.pool.acquire(batch_array_by_column_name, batch_count_by_entity_name)
+        try:
+            array_by_column_name_list = [{} for request in requests]
+            for column_name in batch_columns_name:
+                offsets = offsets_by_entity_name[self.entity_name_by_column_name[column_name]]
+                # Copy the arrays, because the pool reuses the simulation.
+                for array_by_column_name, array in zip(array_by_column_name_list,
+                        np.split(simulation.compute(column_name).copy(), offsets[1:-1])):
+                    array_by_column_name[column_name] = array
+            return array_by_column_name_list
+        finally:
+            with self.lock:
+                self.pool.release(simulation)
+
+    def flush(self):
+        """Send the pending requests to the executor."""
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        requests = self.pending_requests
+        if requests:
+            self.pending_requests = []
+            self.executor.submit(self.compute_batch, requests)
+
+    def set_exception(self, request):
+        """Fail a request with the exception being handled."""
+        key, future, array_by_column_name, count_by_entity_name, columns_name = request
+        # Once computed, a request must no more be coalesced with new ones.
+        with self.lock:
+            del self.future_by_key[key]
+        future.set_exception(sys.exc_info()[1])
+
+    def set_result(self, request, computed_array_by_column_name):
+        key, future, array_by_column_name, count_by_entity_name, columns_name = request
+        with self.lock:
+            del self.future_by_key[key]
+        future.set_result(dict(
+            (column_name, computed_array_by_column_name[column_name])
+            for column_name in columns_name
+            ))
@@ -651,17 +651,90 @@ class SurveySimulation(Simulation):
             self._compute()
         # Note: subset has already be applied
 =======
+import itertools
+
+import numpy as np
+
+from . import holders
+
+
+class SimulationPool(object):
+    """Pool of simulation skeletons, reused by the test cases having the same shape (count of each entity).
+
+    A released simulation keeps its entities, holders and formulas: only its arrays are dropped, so that filling it
+    for the next test case doesn't create Python objects again.
+    """
+    compact_legislation = None
+    date = None
+    disabled_columns_name = None
+    entity_class_by_name = None
+    max_idle_count = None  # Maximum number of idle simulations kept for each shape
+    simulations_by_shape = None
+    tax_benefit_system = None
+
+    def __init__(self, compact_legislation = None, date = None, disabled_columns_name = None,
+            entity_class_by_name = None, max_idle_count = 8, tax_benefit_system = None):
+        self.compact_legislation = compact_legislation
+        assert date is not None
+        self.date = date
+        self.disabled_columns_name = disabled_columns_name
+        assert entity_class_by_name is not None
+        self.entity_class_by_name = entity_class_by_name
+        self.max_idle_count = max_idle_count
+        self.simulations_by_shape = {}
+        assert tax_benefit_system is not None
+        self.tax_benefit_system = tax_benefit_system
+
+    def acquire(self, array_by_column_name, count_by_entity_name):
+        """Return a simulation of the given shape, filled with the given input arrays."""
+        shape = tuple(sorted(count_by_entity_name.iteritems()))
+        simulations = self.simulations_by_shape.get(shape)
+        if simulations:
+            simulation = simulations.pop()
+        else:
+            simulation = Simulation(compact_legislation = self.compact_legislation, date = self.date,
+                disabled_columns_name = self.disabled_columns_name, tax_benefit_system = self.tax_benefit_system)
+            entity_by_name = {}
+            for entity_name, count in shape:
+                entity = self.entity_class_by_name[entity_name](simulation = simulation)
+                entity.count = count
+                entity_by_name[entity_name] = entity
+            simulation.set_entities(entity_by_name)
+        for column_name, array in array_by_column_name.iteritems():
+            holder = simulation.get_or_new_holder(column_name)
+            holder.array = np.array(array, dtype = holder.column._dtype)
+            assert len(holder.array) == holder.entity.count, 'Wrong length for column {}'.format(column_name)
+        return simulation
+
+    def release(self, simulation):
+        """Give back a simulation to the pool. The arrays it computed must no more be used after."""
+        shape = tuple(sorted(
+            (entity_name, entity.count)
+            for entity_name, entity in simulation.entities.iteritems()
+            ))
+        simulations = self.simulations_by_shape.setdefault(shape, [])
+        if len(simulations) >= self.max_idle_count:
+            return
+        for entity in simulation.entities.itervalues():
+            for holder in entity.holder_by_name.itervalues():
+                holder.array = holder.computed_array = None
+        simulations.append(simulation)
+
+
 class Simulation(object):
     compact_legislation = None
     date = None
     default_compact_legislation = None
+    disabled_columns_name = None  # Columns that keep their default value in this simulation
     entities = None
     entity_by_column_name = None
     tax_benefit_system = None
 
-    def __init__(self, compact_legislation = None, date = None, tax_benefit_system = None):
+    def __init__(self, compact_legislation = None, date = None, disabled_columns_name = None,
+            tax_benefit_system = None):
         assert date is not None
         self.date = date
+        self.disabled_columns_name = frozenset(disabled_columns_name or ())
         assert tax_benefit_system is not None
         self.tax_benefit_system = tax_benefit_system
 
@@ -699,3 +772,217 @@ class Simulation(object):
         if holder is None:
             holder = entity.new_holder(column_name)
         return holder
+
+    def compute_marginal_rates(self, output_name, input_name, delta = 1, index = None):
+        """Compute the marginal rates d(output) / d(input) by finite difference.
+
+        index selects the rows of the entity of the input whose input is increased by delta: a row, a sequence of rows
+        or a boolean mask (all the rows by default). Return, for each row of the entity of the output, the variation of
+        the output divided by delta. When the output belongs to a bigger entity than the input (eg a tax of a family
+        computed from the salary of its members) and every member is perturbed at once, this is the sum of the
+        marginal rates of its members: give the index of a single member per entity to get his own marginal rate.
+
+        Base and perturbed inputs are evaluated in a single pass, in a stacked simulation where every entity is
+        doubled: its second half holds the perturbed input. The arrays already computed that don't depend on the
+        input are reused instead of being computed again.
+        """
+        input_array = self.compute(input_name)
+        perturbed_array = input_array + delta
+        if index is not None:
+            perturbed_array = input_array.copy()
+            perturbed_array[index] += delta
+        stacked = self.new_stacked_simulation(2, {input_name: True})
+        stacked.get_or_new_holder(input_name).array = np.concatenate((input_array, perturbed_array))
+        output_array = stacked.compute(output_name)
+        count = len(output_array) // 2
+        return (output_array[count:] - output_array[:count]) / float(delta)
+
+    def compute_sweep(self, columns_name, axes, index = 0):
+        """Compute columns over the grid of every combination of the axes values, in a single pass.
+
+        axes is a sequence of (x_axis, values) or (x_axis, values, index) tuples, where x_axis is an XAxis or a column
+        name and index is the position, in the entity of the column, of the member given the values (index argument,
+        ie the first person, by default). Many axes may vary the same column, for different members.
+
+        Return a couple: a dict giving, for each column, an array of shape (len(values) for each axis) +
+        (entity count,), and the list of the (column name, values, index) of each axis, labelling the dimensions of
+        the arrays.
+        """
+        axes = [
+            (
+                axis[0] if isinstance(axis[0], basestring) else axis[0].col_name,
+                np.asarray(axis[1]),
+                axis[2] if len(axis) > 2 else index,
+                )
+            for axis in axes
+            ]
+        shape = tuple(len(values) for column_name, values, axis_index in axes)
+        points_count = int(np.prod(shape))
+        stacked = self.new_stacked_simulation(points_count, dict(
+            (column_name, True)
+            for column_name, values, axis_index in axes
+            ))
+        # For each axis, index of the value of each point of the grid
+        value_index_by_axis = np.unravel_index(np.arange(points_count), shape)
+        array_by_axis_column_name = {}
+        for (column_name, values, axis_index), value_index in itertools.izip(axes, value_index_by_axis):
+            array = array_by_axis_column_name.get(column_name)
+            if array is None:
+                entity = self.entity_by_column_name[column_name]
+                array_by_axis_column_name[column_name] = array = np.tile(self.compute(column_name),
+                    points_count).reshape(points_count, entity.count)
+            array[:, axis_index] = values[value_index]
+        for column_name, array in array_by_axis_column_name.iteritems():
+            stacked.get_or_new_holder(column_name).array = array.ravel()
+        return dict(
+            (column_name, stacked.compute(column_name).reshape(shape + (-1,)))
+            for column_name in columns_name
+            ), axes
+
+    def depends_on(self, column_name, depends_by_name):
+        """Return whether column depends (transitively) on one of the columns flagged True in depends_by_name.
+
+        depends_by_name is filled with the result for every column visited.
+        """
+        depends = depends_by_name.get(column_name)
+        if depends is None:
+            depends_by_name[column_name] = False  # Guard against dependency cycles.
+            # Don't register a new holder in the entity, only to read its formula.
+            holder = self.get_holder(column_name, None)
+            if holder is None:
+                entity = self.entity_by_column_name[column_name]
+                holder = holders.Holder(column = entity.column_by_name[column_name], entity = entity)
+            formula = holder.formula
+            depends = formula is not None and any(
+                self.depends_on(parameter, depends_by_name)
+                for parameter in formula.parameters
+                )
+            depends_by_name[column_name] = depends
+        return depends
+
+    def new_stacked_simulation(self, copies_count, depends_by_name):
+        """Return a new simulation whose entities are made of copies_count copies of the entities of this simulation.
+
+        The arrays already computed are tiled into the new simulation, except those depending on a column flagged True
+        in depends_by_name (cf depends_on), which are left to be computed again.
+        """
+        stacked = self.__class__(compact_legislation = self.compact_legislation, date = self.date,
+            disabled_columns_name = self.disabled_columns_name, tax_benefit_system = self.tax_benefit_system)
+        stacked.default_compact_legislation = self.default_compact_legislation
+        stacked_entity_by_name = {}
+        for entity_name, entity in self.entities.iteritems():
+            stacked_entity = entity.__class__(simulation = stacked)
+            stacked_entity.column_by_name = entity.column_by_name
+            stacked_entity.count = entity.count * copies_count
+            for column_name, holder in entity.holder_by_name.items():
+                if holder.array is None or self.depends_on(column_name, depends_by_name):
+                    continue
+                stacked_entity.new_holder(column_name).array = np.tile(holder.array, copies_count)
+            stacked_entity_by_name[entity_name] = stacked_entity
+        # In each copy, individuals must refer to the same copy of the other entities.
+        individus = self.entities['individus']
+        stacked_individus = stacked_entity_by_name['individus']
+        for entity in self.entities.itervalues():
+            if entity is individus:
+                continue
+            id_holder = stacked_individus.holder_by_name.get('id' + entity.symbol)
+            if id_holder is not None:
+                id_holder.array += np.repeat(np.arange(copies_count, dtype = id_holder.array.dtype) * entity.count,
+                    individus.count)
+        stacked.set_entities(stacked_entity_by_name)
+        return stacked
+
+
+def compute_test_cases(simulations, columns_name):
+    """Compute columns for many (small) simulations in a single vectorized pass.
+
+    The entities of the simulations, which must share their legislation, date and tax-benefit system, are concatenated
+    into a single simulation, whose individuals refer to the right entities through offset id columns.
+
+    The arrays given as input are used even for columns having a formula. Because such a column can't be both given
+    and computed in a batch, the simulations are batched by set of formula columns given as input.
+
+    Return a list giving, for each simulation, a dict of the arrays of the computed columns.
+    """
+    simulations_index_by_given_formulas_name = {}
+    for simulation_index, simulation in enumerate(simulations):
+        given_formulas_name = frozenset(
+            column_name
+            for entity in simulation.entities.itervalues()
+            for column_name, holder in entity.holder_by_name.iteritems()
+            if holder.formula is not None and holder.array is not None and holder.array is not holder.computed_array
+            )
+        simulations_index_by_given_formulas_name.setdefault(given_formulas_name, []).append(simulation_index)
+    if len(simulations_index_by_given_formulas_name) == 1:
+        return compute_test_cases_batch(simulations, columns_name)
+    array_by_column_name_list = [None] * len(simulations)
+    for simulations_index in simulations_index_by_given_formulas_name.itervalues():
+        for simulation_index, array_by_column_name in itertools.izip(simulations_index, compute_test_cases_batch(
+                [simulations[simulation_index] for simulation_index in simulations_index], columns_name)):
+            array_by_column_name_list[simulation_index] = array_by_column_name
+    return array_by_column_name_list
+
+
+def compute_test_cases_batch(simulations, columns_name):
+    """Compute columns for simulations giving the same formula columns as input, in a single vectorized pass."""
+    first_simulation = simulations[0]
+    for simulation in simulations:
+        assert simulation.compact_legislation is first_simulation.compact_legislation
+        assert simulation.date == first_simulation.date
+        assert simulation.disabled_columns_name == first_simulation.disabled_columns_name
+        assert simulation.tax_benefit_system is first_simulation.tax_benefit_system
+    batch = Simulation(compact_legislation = first_simulation.compact_legislation, date = first_simulation.date,
+        disabled_columns_name = first_simulation.disabled_columns_name,
+        tax_benefit_system = first_simulation.tax_benefit_system)
+    batch.default_compact_legislation = first_simulation.default_compact_legislation
+
+    batch_entity_by_name = {}
+    offsets_by_symbol = {}
+    for entity_name, first_entity in first_simulation.entities.iteritems():
+        entities = [
+            simulation.entities[entity_name]
+            for simulation in simulations
+            ]
+        offsets_by_symbol[first_entity.symbol] = offsets = np.cumsum([0] + [entity.count for entity in entities])
+        batch_entity = first_entity.__class__(simulation = batch)
+        batch_entity.column_by_name = first_entity.column_by_name
+        batch_entity.count = offsets[-1]
+        # Only the arrays given as input are concatenated: the others are computed once for the whole batch.
+        input_columns_name = set(
+            column_name
+            for entity in entities
+            for column_name, holder in entity.holder_by_name.iteritems()
+            if holder.array is not None and holder.array is not holder.computed_array
+            )
+        for column_name in input_columns_name:
+            column = first_entity.column_by_name[column_name]
+            arrays = []
+            for entity in entities:
+                holder = entity.holder_by_name.get(column_name)
+                if holder is None or holder.array is None:
+                    array = np.empty(entity.count, dtype = column._dtype)
+                    array.fill(column._default)
+                else:
+                    array = holder.array
+                arrays.append(array)
+            batch_entity.new_holder(column_name).array = np.concatenate(arrays)
+        batch_entity_by_name[entity_name] = batch_entity
+
+    batch_individus = batch_entity_by_name['individus']
+    individus_counts = np.diff(offsets_by_symbol[batch_individus.symbol])
+    for batch_entity in batch_entity_by_name.itervalues():
+        if batch_entity is batch_individus:
+            continue
+        id_holder = batch_individus.holder_by_name.get('id' + batch_entity.symbol)
+        if id_holder is not None:
+            id_holder.array += np.repeat(offsets_by_symbol[batch_entity.symbol][:-1], individus_counts).astype(
+                id_holder.array.dtype)
+    batch.set_entities(batch_entity_by_name)
+
+    array_by_column_name_list = [{} for simulation in simulations]
+    for column_name in columns_name:
+        offsets = offsets_by_symbol[batch.entity_by_column_name[column_name].symbol]
+        for array_by_column_name, array in itertools.izip(array_by_column_name_list,
+                np.split(batch.compute(column_name), offsets[1:-1])):
+            array_by_column_name[column_name] = array
+    return array_by_column_name_list
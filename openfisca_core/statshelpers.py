@@ -27,10 +27,169 @@ from __future__ import division
 
 import numpy as np
 from numpy import cumsum, ones
-from pandas import DataFrame
 
 
-def gini(values, weights = None, bin_size = None):
+class QuantileSketch(object):
+    '''
+    Mergeable sketch of a weighted distribution, for quantiles and Lorenz curves of data too large for one process
+    The sketch is a weighted t-digest: a sorted list of centroids (mean, weight), sized by the arcsine scale function
+    so that each centroid holds at most a share pi * sqrt(q * (1 - q)) / compression of the total weight, q being its
+    rank. Centroids are therefore small in the tails and the error is:
+    - for quantiles, a rank error of at most about pi * sqrt(q * (1 - q)) / (2 * compression), ie 0.4 % at the
+      median and much less at the extreme percentiles for the default compression of 200,
+    - for Lorenz curves, exact points at the boundaries of the centroids, linearly interpolated inside them.
+    Until the number of distinct points exceeds the number of centroids allowed, the results are those of the exact
+    functions (weighted_quantiles with method 1, lorenz, gini), which are applied to the centroids.
+    Update it chunk by chunk, merge the sketches of the workers (they are picklable), then query it. The results of an
+    empty sketch are NaN.
+    '''
+    compression = None
+    means = None  # Sorted
+    weights = None
+
+    def __init__(self, compression = 200):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+
+    def compress(self, means, weights):
+        sort_index = np.argsort(means, kind = 'mergesort')
+        means = means.take(sort_index)
+        weights = weights.take(sort_index)
+        if len(means) > self.compression:
+            cumulated_weights = cumsum(weights)
+            q = (cumulated_weights - 0.5 * weights) / cumulated_weights[-1]
+            # Arcsine scale function: each centroid spans at most one unit of k.
+            k = np.floor(self.compression * (np.arcsin(2 * q - 1) / np.pi + 0.5)).astype(np.intp)
+            clusters = np.concatenate(([0], np.cumsum(k[1:] != k[:-1])))
+            cluster_weights = np.bincount(clusters, weights = weights)
+            means = np.bincount(clusters, weights = weights * means) / cluster_weights
+            weights = cluster_weights
+        self.means = means
+        self.weights = weights
+
+    def gini(self):
+        if len(self.means) == 0:
+            return np.nan
+        return gini(self.means, self.weights, sort_index = np.arange(len(self.means)))
+
+    def lorenz(self, grid = 101):
+        if len(self.means) == 0:
+            grid = np.linspace(0, 1, grid) if np.isscalar(grid) else np.asarray(grid, dtype = float)
+            return grid, np.repeat(np.nan, len(grid))
+        return lorenz(self.means, self.weights, grid = grid, sort_index = np.arange(len(self.means)))
+
+    def merge(self, other):
+        '''Add the distribution of another sketch to this one, and return this one.'''
+        self.compress(np.concatenate((self.means, other.means)), np.concatenate((self.weights, other.weights)))
+        return self
+
+    def quantiles(self, breaks):
+        if len(self.means) == 0:
+            return np.repeat(np.nan, len(breaks))
+        return weighted_quantiles(self.means, self.weights, breaks, sort_index = np.arange(len(self.means)))
+
+    @property
+    def total_weight(self):
+        return self.weights.sum()
+
+    def update(self, values, weights = None):
+        '''Add a chunk of observations to the sketch, and return it.'''
+        values = np.asarray(values, dtype = float)
+        weights = ones(len(values)) if weights is None else np.asarray(weights, dtype = float)
+        kept = (weights > 0) & ~np.isnan(values)
+        self.compress(np.concatenate((self.means, values[kept])), np.concatenate((self.weights, weights[kept])))
+        return self
+
+
+class BootstrapWeights(object):
+    '''
+    Generator of Poisson bootstrap replicate weights, drawn chunk by chunk (cf replicate_concentration_indexes)
+    Calling it with (start, stop) returns the replicates start to stop - 1, as an array (stop - start, len(weights)).
+    The draws of each chunk depend only on seed and start, so that they don't depend on the order of computation of
+    the chunks. It is picklable, for process executors.
+    '''
+    seed = None
+    weights = None
+
+    def __init__(self, weights, seed = 0):
+        self.seed = seed
+        self.weights = np.asarray(weights, dtype = float)
+
+    def __call__(self, start, stop):
+        random_state = np.random.RandomState([self.seed, start])
+        return random_state.poisson(1, size = (stop - start, len(self.weights))) * self.weights
+
+
+def bootstrap_weights(weights, replicates_count, random_state = None):
+    '''
+    Returns an array (replicates_count, len(weights)) of Poisson bootstrap replicate weights, ie of weights multiplied
+    by independent Poisson(1) draw counts
+    random_state is a np.random.RandomState or a seed.
+    The whole matrix is kept in memory: for many replicates of large samples, give a BootstrapWeights to the
+    replicate_* functions instead.
+    '''
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+    weights = np.asarray(weights, dtype = float)
+    return random_state.poisson(1, size = (replicates_count, len(weights))) * weights
+
+
+def concentration_curves(values_by_name, ineq_axis, weights = None, grid = 101, sort_index = None):
+    '''
+    Computes the concentration (pseudo Lorenz) curves of many variables, for observations ranked by ineq_axis
+    Returns the population shares of the grid and a dict of the curves by name, sorting only once.
+    '''
+    if sort_index is None:
+        sort_index = np.argsort(ineq_axis, kind = 'mergesort')
+    x_by_name = {}
+    y_by_name = {}
+    for name, values in values_by_name.iteritems():
+        x_by_name[name], y_by_name[name] = lorenz(values, weights, grid = grid, sort_index = sort_index)
+    x = x_by_name.itervalues().next() if x_by_name else None
+    return x, y_by_name
+
+
+def concentration_index(values, ineq_axis, weights = None, groups = None, sort_index = None):
+    '''
+    Concentration coefficient of values, for observations ranked by ineq_axis (cf gini)
+    When groups (an array of non-negative integer codes) is given, returns the array of the coefficients of each group.
+    sort_index is the result of np.argsort(ineq_axis, kind = 'mergesort'), when it is already known.
+    '''
+    values = np.asarray(values, dtype = float)
+    if weights is None:
+        weights = ones(len(values))
+    else:
+        weights = np.asarray(weights, dtype = float)
+    if sort_index is None:
+        sort_index = np.argsort(ineq_axis, kind = 'mergesort')
+    if groups is None:
+        w = weights.take(sort_index)
+        wx = w * values.take(sort_index)
+        cdf = cumsum(wx) - 0.5 * wx
+        numerator = (w * cdf).sum()
+        denominator = wx.sum() * w.sum()
+        return 1 - 2 * (numerator / denominator)
+
+    # A stable sort by group keeps the ranking inside each group.
+    groups = np.asarray(groups)
+    sort_index = sort_index.take(np.argsort(groups.take(sort_index), kind = 'mergesort'))
+    g = groups.take(sort_index)
+    w = weights.take(sort_index)
+    wx = w * values.take(sort_index)
+    cumulated_wx = cumsum(wx)
+    # Restart the cumulative sum at the beginning of each group.
+    groups_count = np.bincount(g)
+    groups_start = np.cumsum(groups_count) - groups_count
+    cumulated_wx -= np.repeat(cumulated_wx.take(groups_start) - wx.take(groups_start), groups_count)
+    cdf = cumulated_wx - 0.5 * wx
+    numerator = np.bincount(g, weights = w * cdf)
+    denominator = np.bincount(g, weights = wx) * np.bincount(g, weights = w)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return 1 - 2 * (numerator / denominator)
+
+
+def gini(values, weights = None, bin_size = None, groups = None, sort_index = None):
     '''
     Gini coefficient (normalized to 1)
     Using fastgini formula :
@@ -48,62 +207,62 @@ def gini(values, weights = None, bin_size = None):
         where observations are sorted in ascending order of X.
 
     From http://fmwww.bc.edu/RePec/bocode/f/fastgini.html
-    '''
-    if weights is None:
-        weights = ones(len(values))
-
-    df = DataFrame({'x': values, 'w':weights})
-    df = df.sort_index(by='x')
-    x = df['x']
-    w = df['w']
-    wx = w*x
-
-    cdf = cumsum(wx)-0.5*wx
-    numerator = (w*cdf).sum()
-    denominator = ((wx).sum())*(w.sum())
-    gini = 1 - 2*(numerator/denominator)
 
-    return gini
+    When groups is given, returns the array of the Gini coefficients of each group (cf concentration_index).
+    '''
+    return concentration_index(values, values, weights = weights, groups = groups, sort_index = sort_index)
 
 
-def kakwani(values, ineq_axis, weights = None):
+def kakwani(values, ineq_axis, weights = None, groups = None, sort_index = None):
     '''
-    Computes the Kakwani index
+    Computes the Kakwani index, ie the area between the Lorenz curve of ineq_axis and the concentration curve of
+    values
+    The area is integrated with the trapezoidal rule, from the origin, so it is half the difference between the
+    concentration coefficient of values and the Gini coefficient of ineq_axis, which share the same ordering.
     '''
-    from scipy.integrate import simps
-
-    if weights is None:
-        weights = ones(len(values))
-
-#    sign = -1
-#    if tax == True:
-#        sign = -1
-#    else:
-#        sign = 1
-
-    PLCx, PLCy = pseudo_lorenz(values, ineq_axis, weights)
-    LCx, LCy = lorenz(ineq_axis, weights)
-
-    del PLCx
-
-    return simps((LCy - PLCy), LCx)
+    if sort_index is None:
+        sort_index = np.argsort(ineq_axis, kind = 'mergesort')
+    return (concentration_index(values, ineq_axis, weights = weights, groups = groups, sort_index = sort_index)
+        - gini(ineq_axis, weights = weights, groups = groups, sort_index = sort_index)) / 2
 
 
-def lorenz(values, weights = None):
+def lorenz(values, weights = None, grid = None, sort_index = None):
     '''
     Computes Lorenz Curve coordinates
+    When grid is given (a number of points or an array of population shares), the curve is interpolated on it,
+    starting from the origin.
     '''
+    values = np.asarray(values, dtype = float)
     if weights is None:
         weights = ones(len(values))
-
-    df = DataFrame({'v': values, 'w':weights})
-    df = df.sort_index(by = 'v')
-    x = cumsum(df['w'])
-    x = x/float(x[-1:])
-    y = cumsum(df['v']*df['w'])
-    y = y/float(y[-1:])
-
-    return x, y
+    else:
+        weights = np.asarray(weights, dtype = float)
+    if sort_index is None:
+        sort_index = np.argsort(values, kind = 'mergesort')
+    w = weights.take(sort_index)
+    x = cumsum(w)
+    x = x / x[-1]
+    y = cumsum(values.take(sort_index) * w)
+    y = y / y[-1]
+    if grid is None:
+        return x, y
+
+    if np.isscalar(grid):
+        grid = np.linspace(0, 1, grid)
+    return grid, np.interp(grid, np.concatenate(([0], x)), np.concatenate(([0], y)))
+
+
+def mark_quantiles(a, quantiles):
+    '''
+    Returns the index of the x-tile of each value of a, given the breakpoints quantiles (of length number of x-tiles
+    + 1)
+    Values below the first breakpoint are in the first x-tile, values above the last one in the last x-tile.
+    '''
+    index = np.searchsorted(quantiles, a, side = 'right') - 1
+    np.clip(index, 0, len(quantiles) - 2, out = index)
+    index[a <= quantiles[0]] = 0
+    index[a >= quantiles[-1]] = len(quantiles) - 2
+    return index
 
 
 def mark_weighted_percentiles(a, labels, weights, method, return_quantiles=False):
@@ -117,157 +276,206 @@ def mark_weighted_percentiles(a, labels, weights, method, return_quantiles=False
     # The code outputs an array the same shape as 'a', but with
     # labels[i] inserted into spot j if a[j] falls in x-tile i.
     # The number of xtiles requested is inferred from the length of 'labels'.
+    # The quantiles are computed by weighted_quantiles, with a single sort.
+    num_categories = len(labels)
+    ret = np.repeat(0, len(a))
+    if len(a) < num_categories:
+        return (ret, []) if return_quantiles else ret
+
+    # 'labels' stores the name of the x-tiles the user wants,
+    # and it is assumed to be linearly spaced between 0 and 1
+    # so 5 labels implies quintiles, for example.
+    quantiles = weighted_quantiles(a, weights, np.linspace(0, 1, num_categories + 1), method = method)
+    ret[:] = np.asarray(labels)[mark_quantiles(a, quantiles)]
+    # Leave NaN values unmarked.
+    ret[np.isnan(a)] = 0
+
+    if return_quantiles:
+        return ret, list(quantiles)
+    else:
+        return ret
 
 
-    # First method, "vanilla" weights from Wikipedia article.
-    if method == 1:
+def pseudo_lorenz(values, ineq_axis, weights = None, grid = None, sort_index = None):
+    '''
+    Computes The pseudo Lorenz Curve coordinates
+    '''
+    if sort_index is None:
+        sort_index = np.argsort(ineq_axis, kind = 'mergesort')
+    return lorenz(values, weights, grid = grid, sort_index = sort_index)
 
-        # Sort the values and apply the same sort to the weights.
-        N = len(a)
-        sort_indx = np.argsort(a)
-        tmp_a = a[sort_indx].copy()
-        tmp_weights = weights[sort_indx].copy()
-
-        # 'labels' stores the name of the x-tiles the user wants,
-        # and it is assumed to be linearly spaced between 0 and 1
-        # so 5 labels implies quintiles, for example.
-        num_categories = len(labels)
-        breaks = np.linspace(0, 1, num_categories+1)
-
-        # Compute the percentile values at each explicit data point in a.
-        cu_weights = np.cumsum(tmp_weights)
-        p_vals = (1.0/cu_weights[-1])*(cu_weights - 0.5*tmp_weights)
-
-        # Set up the output array.
-        ret = np.repeat(0, len(a))
-        if(len(a)<num_categories):
-            return ret
-
-        # Set up the array for the values at the breakpoints.
-        quantiles = []
-
-
-        # Find the two indices that bracket the breakpoint percentiles.
-        # then do interpolation on the two a_vals for those indices, using
-        # interp-weights that involve the cumulative sum of weights.
-        for brk in breaks:
-            if brk <= p_vals[0]:
-                i_low = 0
-                i_high = 0
-            elif brk >= p_vals[-1]:
-                i_low = N-1
-                i_high = N-1
-            else:
-                for ii in range(N-1):
-                    if (p_vals[ii] <= brk) and (brk < p_vals[ii+1]):
-                        i_low  = ii
-                        i_high = ii + 1
-
-            if i_low == i_high:
-                v = tmp_a[i_low]
-            else:
-                # If there are two brackets, then apply the formula as per Wikipedia.
-                v = tmp_a[i_low] + ((brk-p_vals[i_low])/(p_vals[i_high]-p_vals[i_low]))*(tmp_a[i_high]-tmp_a[i_low])
-
-            # Append the result.
-            quantiles.append(v)
-
-        # Now that the weighted breakpoints are set, just categorize
-        # the elements of a with logical indexing.
-        for i in range(0, len(quantiles)-1):
-            lower = quantiles[i]
-            upper = quantiles[i+1]
-            ret[np.logical_and(a>=lower, a<upper)] = labels[i]
-
-        #make sure upper and lower indices are marked
-        ret[a<=quantiles[0]] = labels[0]
-        ret[a>=quantiles[-1]] = labels[-1]
 
-        return ret
+def compute_replicate_concentration_indexes_chunk(sorted_values_list, sort_index, replicate_weights, start, stop):
+    '''
+    Computes the concentration coefficients of the replicates start to stop - 1 (cf replicate_concentration_indexes)
+    replicate_weights is either the array of the weights of these replicates or a generator of replicate weights.
+    '''
+    w = replicate_weights(start, stop) if callable(replicate_weights) else replicate_weights
+    w = np.asarray(w, dtype = float).take(sort_index, axis = 1)
+    w_sum = w.sum(axis = 1)
+    indexes = []
+    for sorted_values in sorted_values_list:
+        wx = w * sorted_values
+        cdf = cumsum(wx, axis = 1)
+        cdf -= 0.5 * wx
+        numerator = np.einsum('ij,ij->i', w, cdf)
+        denominator = wx.sum(axis = 1) * w_sum
+        indexes.append(1 - 2 * (numerator / denominator))
+    return indexes
+
+
+def replicate_concentration_indexes(values_list, replicate_weights, sort_index, chunk_size = 16, executor = None,
+        replicates_count = None):
+    '''
+    Computes the concentration coefficients (cf concentration_index) of each array of values_list, for every
+    replicate of weights, with observations ranked by sort_index
+    replicate_weights is either an array of shape (replicates count, observations count) or a generator of replicate
+    weights (cf BootstrapWeights) called with (start, stop) for each chunk, in which case replicates_count is required
+    and only chunk_size replicates are in memory at once.
+    The replicates are processed by chunks of chunk_size rows, each chunk reusing the same ordering. When executor
+    (a concurrent.futures executor) is given, the chunks are computed in parallel. With a process executor, the sorted
+    values are sent with each chunk, and the generator must be picklable.
+    Returns an array of shape (len(values_list), replicates count).
+    '''
+    sorted_values_list = [
+        np.asarray(values, dtype = float).take(sort_index)
+        for values in values_list
+        ]
+    if callable(replicate_weights):
+        assert replicates_count is not None, 'replicates_count is required with a generator of replicate weights'
+    else:
+        replicates_count = len(replicate_weights)
+    arguments_list = [
+        (
+            sorted_values_list,
+            sort_index,
+            replicate_weights if callable(replicate_weights) else replicate_weights[start:start + chunk_size],
+            start,
+            min(start + chunk_size, replicates_count),
+            )
+        for start in range(0, replicates_count, chunk_size)
+        ]
+    if executor is None:
+        chunks = [
+            compute_replicate_concentration_indexes_chunk(*arguments)
+            for arguments in arguments_list
+            ]
+    else:
+        chunks = [
+            future.result()
+            for future in [
+                executor.submit(compute_replicate_concentration_indexes_chunk, *arguments)
+                for arguments in arguments_list
+                ]
+            ]
+    if not chunks:
+        return np.empty((len(values_list), 0))
+    return np.array([
+        np.concatenate([chunk[index] for chunk in chunks])
+        for index in range(len(values_list))
+        ])
+
+
+def replicate_gini(values, replicate_weights, sort_index = None, chunk_size = 16, executor = None,
+        replicates_count = None):
+    '''
+    Computes the Gini coefficient for every replicate of weights, in a single batched pass
+    Cf replicate_concentration_indexes and replicate_variance.
+    '''
+    if sort_index is None:
+        sort_index = np.argsort(values, kind = 'mergesort')
+    return replicate_concentration_indexes([values], replicate_weights, sort_index, chunk_size = chunk_size,
+        executor = executor, replicates_count = replicates_count)[0]
 
-    # The stats.stackexchange suggestion.
-    elif method == 2:
 
-        N = len(a)
-        sort_indx = np.argsort(a)
-        tmp_a = a[sort_indx].copy()
-        tmp_weights = weights[sort_indx].copy()
+def replicate_kakwani(values, ineq_axis, replicate_weights, sort_index = None, chunk_size = 16, executor = None,
+        replicates_count = None):
+    '''
+    Computes the Kakwani index (cf kakwani) for every replicate of weights, in a single batched pass
+    '''
+    if sort_index is None:
+        sort_index = np.argsort(ineq_axis, kind = 'mergesort')
+    concentration, gini = replicate_concentration_indexes([values, ineq_axis], replicate_weights, sort_index,
+        chunk_size = chunk_size, executor = executor, replicates_count = replicates_count)
+    return (concentration - gini) / 2
+
 
+def replicate_variance(replicate_estimates, estimate = None, scale = None):
+    '''
+    Variance of an estimator, given its estimates for each replicate
+    By default, the bootstrap variance: deviations are taken from the mean of the replicates and scale is 1 / (R - 1).
+    For other replication methods, give the full sample estimate and the scale (for example (R - 1) / R for the
+    jackknife, 1 / R for balanced repeated replication).
+    '''
+    replicate_estimates = np.asarray(replicate_estimates, dtype = float)
+    replicates_count = replicate_estimates.shape[-1]
+    if estimate is None:
+        estimate = replicate_estimates.mean(axis = -1)
+    if scale is None:
+        scale = 1 / (replicates_count - 1)
+    return scale * ((replicate_estimates - np.expand_dims(estimate, -1)) ** 2).sum(axis = -1)
 
-        num_categories = len(labels)
-        breaks = np.linspace(0, 1, num_categories+1)
 
-        cu_weights = np.cumsum(tmp_weights)
+def reynolds_smolensky(values_before, values_after, weights = None, groups = None, sort_index = None):
+    '''
+    Computes the Reynolds-Smolensky index, ie the Gini coefficient of values_before minus the concentration coefficient
+    of values_after, both ranked by values_before
+    It differs from the reduction of the Gini coefficient (the redistributive effect) by the reranking effect.
+    sort_index is the result of np.argsort(values_before, kind = 'mergesort'), when it is already known.
+    '''
+    if sort_index is None:
+        sort_index = np.argsort(values_before, kind = 'mergesort')
+    return gini(values_before, weights = weights, groups = groups, sort_index = sort_index) - concentration_index(
+        values_after, values_before, weights = weights, groups = groups, sort_index = sort_index)
+
 
+def weighted_quantiles(a, weights, breaks, method = 1, sort_index = None):
+    '''
+    Returns the weighted quantiles of a at the breaks (probabilities between 0 and 1)
+    method is 1 for the interpolation of the wikipedia article, 2 for the stackexchange post (cf
+    mark_weighted_percentiles).
+    sort_index is the result of np.argsort(a), when it is already known.
+    '''
+    a = np.asarray(a)
+    breaks = np.asarray(breaks, dtype = float)
+    if sort_index is None:
+        sort_index = np.argsort(a)
+    sorted_a = a.take(sort_index)
+    sorted_weights = np.asarray(weights, dtype = float).take(sort_index)
+    N = len(a)
+    cu_weights = np.cumsum(sorted_weights)
+    if method == 1:
+        # Percentile of each explicit data point
+        p_vals = (cu_weights - 0.5 * sorted_weights) / cu_weights[-1]
+    elif method == 2:
         # Formula from stats.stackexchange.com post.
-        s_vals = [0.0]
-        for ii in range(1,N):
-            s_vals.append(ii*tmp_weights[ii] + (N-1)*cu_weights[ii-1])
-        s_vals = np.asarray(s_vals)
-
-        # Normalized s_vals for comapring with the breakpoint.
-        norm_s_vals = (1.0/s_vals[-1])*s_vals
-
-        # Set up the output variable.
-        ret = np.repeat(0, N)
-        if(N < num_categories):
-            return ret
-
-        # Set up space for the values at the breakpoints.
-        quantiles = []
-
-
-        # Find the two indices that bracket the breakpoint percentiles.
-        # then do interpolation on the two a_vals for those indices, using
-        # interp-weights that involve the cumulative sum of weights.
-        for brk in breaks:
-            if brk <= norm_s_vals[0]:
-                i_low = 0
-                i_high = 0
-            elif brk >= norm_s_vals[-1]:
-                i_low = N-1
-                i_high = N-1
-            else:
-                for ii in range(N-1):
-                    if (norm_s_vals[ii] <= brk) and (brk < norm_s_vals[ii+1]):
-                        i_low  = ii
-                        i_high = ii + 1
-
-            if i_low == i_high:
-                v = tmp_a[i_low]
-            else:
-                # Interpolate as in the method 1 method, but using the s_vals instead.
-                v = tmp_a[i_low] + (((brk*s_vals[-1])-s_vals[i_low])/(s_vals[i_high]-s_vals[i_low]))*(tmp_a[i_high]-tmp_a[i_low])
-            quantiles.append(v)
-
-        # Now that the weighted breakpoints are set, just categorize
-        # the elements of a as usual.
-        for i in range(0, len(quantiles)-1):
-            lower = quantiles[i]
-            upper = quantiles[i+1]
-            ret[np.logical_and(a >= lower, a < upper)] = labels[i]
-
-        #make sure upper and lower indices are marked
-        ret[a<=quantiles[0]] = labels[0]
-        ret[a>=quantiles[-1]] = labels[-1]
-
-        if return_quantiles:
-            return ret, quantiles
-        else:
-            return ret
-
-
-def pseudo_lorenz(values, ineq_axis, weights = None):
+        s_vals = np.empty(N)
+        s_vals[0] = 0
+        s_vals[1:] = np.arange(1, N) * sorted_weights[1:] + (N - 1) * cu_weights[:-1]
+        p_vals = s_vals / s_vals[-1]
+    else:
+        raise ValueError('method should be 1 or 2')
+
+    # Find the two indices that bracket the breakpoint percentiles, then interpolate between them.
+    i_low = np.searchsorted(p_vals, breaks, side = 'right') - 1
+    np.clip(i_low, 0, N - 1, out = i_low)
+    i_high = np.minimum(i_low + 1, N - 1)
+    low_p_vals = p_vals.take(i_low)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        quantiles = sorted_a.take(i_low) + (breaks - low_p_vals) / (p_vals.take(i_high) - low_p_vals) * (
+            sorted_a.take(i_high) - sorted_a.take(i_low))
+    quantiles[breaks <= p_vals[0]] = sorted_a[0]
+    quantiles[breaks >= p_vals[-1]] = sorted_a[-1]
+    return quantiles
+
+
+def weighted_quantiles_by_name(values_by_name, weights, breaks, method = 1):
     '''
-    Computes The pseudo Lorenz Curve coordinates
+    Returns a dict giving the weighted quantiles (cf weighted_quantiles) of each array of values_by_name
+    For example, the deciles of many variables:
+        weighted_quantiles_by_name(values_by_name, weights, np.linspace(0, 1, 11))
     '''
-    if weights is None:
-        weights = ones(len(values))
-    df = DataFrame({'v': values, 'a': ineq_axis, 'w':weights})
-    df = df.sort_index(by = 'a')
-    x = cumsum(df['w'])
-    x = x/float(x[-1:])
-    y = cumsum(df['v']*df['w'])
-    y = y/float(y[-1:])
-
-    return x, y
+    return dict(
+        (name, weighted_quantiles(values, weights, breaks, method = method))
+        for name, values in values_by_name.iteritems()
+        )
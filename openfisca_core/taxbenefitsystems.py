@@ -24,6 +24,7 @@
 
 
 import collections
+import datetime
 import xml.etree.ElementTree
 import weakref
 #from xml.dom import minidom
@@ -32,7 +33,7 @@ import numpy as np
 from pandas import DataFrame
 
 <<<<<<< HEAD
-from . import model
+from . import dependencygraphs, model
 from .datatables import DataTable
 
 
@@ -189,6 +190,9 @@ class OutNode(object):
 class TaxBenefitSystem(DataTable):
     def __init__(self, column_by_name, param, defaultParam = None, datesim = None, num_table = 1):
         super(TaxBenefitSystem, self).__init__(column_by_name, datesim = datesim, num_table = num_table)
+        self._calculated = None
+        self._disabled = None
+        self._graph = None
         self._primitives = set()
         self._param = param
         self._default_param = defaultParam
@@ -197,8 +201,8 @@ class TaxBenefitSystem(DataTable):
         if datesim is not None:
             self.datesim = datesim
 
-        self.reset()
         self.build()
+        self.reset()
 
     def __add__(self, other):
         """
@@ -220,20 +224,10 @@ class TaxBenefitSystem(DataTable):
         return self
 
     def build(self):
-        # Build the closest dependencies
-        for col in self.column_by_name.itervalues():
-            # Disable column if necessary
-            if col.start is not None and col.start > self.datesim or col.end is not None and col.end < self.datesim:
-                col.disabled = True
-            elif col.disabled:
-                del col.disabled
-
-            for input_varname in col.inputs:
-                input_col = self.column_by_name.get(input_varname)
-                if input_col is None:
-                    self._primitives.add(input_varname)
-                else:
-                    input_col.add_child(col)
+        # The dependency graph is shared by every system using the same columns. Only the flags belong to this system.
+        self._graph = dependencygraphs.get_dependency_graph(self.column_by_name)
+        self._disabled = self._graph.get_disabled(self.datesim)
+        self._primitives = set(self._graph.primitives)
 
     def calculate(self):
         if self.survey_data is not None or self.decomp_file is None:
@@ -244,7 +238,8 @@ class TaxBenefitSystem(DataTable):
             raise Exception("survey_data or test_case attribute should not be None")
 
     def calculate_prestation(self, col):
-        if col.calculated or col.disabled:
+        col_index = self._graph.index_by_name[col.name]
+        if self._calculated[col_index] or self._disabled[col_index]:
             return
 
         columns_name = set(self._inputs.column_by_name)
@@ -264,7 +259,7 @@ class TaxBenefitSystem(DataTable):
                     func_args[var] = self._inputs.get_value(var, entity)
 
         WEIGHT = model.WEIGHT
-        for parent_col in col._parents:
+        for parent_col in self._graph.get_parents(col.name):
             parent_name = parent_col.name
             assert parent_name not in func_args or parent_name == WEIGHT, \
                 '%s provided twice: %s was found in primitives and in parents' % (col.name, col.name)
@@ -303,7 +298,7 @@ class TaxBenefitSystem(DataTable):
             print col.name
             raise
 
-        col.calculated = True
+        self._calculated[col_index] = True
 
     def calculate_survey(self):
         for col in self.column_by_name.itervalues():
@@ -326,7 +321,7 @@ class TaxBenefitSystem(DataTable):
         """Set some column as calculated so they are not evaluated and keep their default value."""
         if disabled_prestations is not None:
             for colname in disabled_prestations:
-                self.column_by_name[colname].calculated = True
+                self._calculated[self._graph.index_by_name[colname]] = True
 
     def generate_output_tree(self, doc, output_tree, entity = 'men'):
         if doc.childNodes:
@@ -373,9 +368,7 @@ class TaxBenefitSystem(DataTable):
         """
         Sets all columns as not calculated
         """
-        for col in self.column_by_name.itervalues():
-            if col.calculated:
-                del col.calculated
+        self._calculated = self._graph.new_flags()
 
     def set_inputs(self, inputs):
         """
@@ -483,9 +476,27 @@ class AbstractTaxBenefitSystem(object):
             compact_legislation = legislations.compact_dated_node_json(dated_legislation_json)
             if self.preprocess_legislation_parameters is not None:
                 self.preprocess_legislation_parameters(compact_legislation)
+            # Freeze the legislation once preprocessed: it is shared by every simulation and cheap to send to workers.
+            compact_legislation = compact_legislation.freeze()
             self.compact_legislation_by_date_str_cache[date_str] = compact_legislation
         return compact_legislation
 
+    def get_vectorial_compact_legislation(self, dates):
+        """Return a legislation whose parameters are arrays giving, for each row, the value at the row's date.
+
+        ``dates`` is an array of dates (``datetime.date`` objects or ``datetime64``), for example the reference date of
+        each individual of a multi-period panel. The compact legislation of each distinct date is built (or taken from
+        cache) only once.
+        """
+        unique_dates, index = np.unique(np.asarray(dates).astype('datetime64[D]'), return_inverse = True)
+        return legislations.VectorialCompactNode(
+            [
+                self.get_compact_legislation(date)
+                for date in unique_dates.astype(datetime.date)
+                ],
+            index,
+            )
+
     @classmethod
     def json_to_instance(cls, value, state = None):
         attributes, error = conv.pipe(
@@ -63,6 +63,7 @@ setup(
     install_requires = [
         'Babel >= 0.9.4',
         'Biryani1[datetimeconv] >= 0.9dev',
+        'futures; python_version < "3"',  # concurrent.futures, used by services.SimulationService
         'numpy',
         'pandas >= 0.13',
         'tables',